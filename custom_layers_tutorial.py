@@ -70,6 +70,93 @@ _ = layer(tf.zeros([10, 5])) # Calling the layer `.builds` it.
 
 print([var.name for var in layer.trainable_variables])
 
+"""# Fused dense layer
+
+MyDenseLayer only does the matmul, so a bias and an activation have to be stacked on top as separate layers, each one launching its own kernel and writing an intermediate tensor.
+
+FusedDenseLayer computes matmul, bias and activation in one call. Using tf.nn.bias_add followed by the activation lets grappler rewrite the graph into a single _FusedMatMul op. With jit_compile=True the forward pass is additionally compiled with XLA.
+"""
+
+class FusedDenseLayer(tf.keras.layers.Layer):
+  def __init__(self, num_outputs, activation=None, use_bias=True,
+               jit_compile=False, **kwargs):
+    super(FusedDenseLayer, self).__init__(**kwargs)
+    self.num_outputs = num_outputs
+    self.activation = tf.keras.activations.get(activation)
+    self.use_bias = use_bias
+    self.jit_compile = jit_compile
+
+  def build(self, input_shape):
+    self.kernel = self.add_weight("kernel",
+                                  shape=[int(input_shape[-1]),
+                                         self.num_outputs])
+    if self.use_bias:
+      self.bias = self.add_weight("bias",
+                                  shape=[self.num_outputs],
+                                  initializer='zeros')
+    else:
+      self.bias = None
+    if self.jit_compile:
+      self._forward = tf.function(self._dense, jit_compile=True)
+    else:
+      self._forward = self._dense
+
+  def _dense(self, inputs):
+    x = tf.matmul(inputs, self.kernel)
+    if self.bias is not None:
+      x = tf.nn.bias_add(x, self.bias)
+    if self.activation is not None:
+      x = self.activation(x)
+    return x
+
+  def call(self, inputs):
+    return self._forward(inputs)
+
+  def get_config(self):
+    config = super(FusedDenseLayer, self).get_config()
+    config.update({
+        'num_outputs': self.num_outputs,
+        'activation': tf.keras.activations.serialize(self.activation),
+        'use_bias': self.use_bias,
+        'jit_compile': self.jit_compile,
+    })
+    return config
+
+layer = FusedDenseLayer(10, activation='relu')
+_ = layer(tf.zeros([10, 5]))
+
+print([var.name for var in layer.trainable_variables])
+
+"""### Benchmark against tf.keras.layers.Dense
+
+every variant runs inside a tf.function so only the layer itself is measured, not the python overhead.
+"""
+
+import time
+
+def benchmark_dense(layer, batch_size, input_dim=512, steps=100):
+  x = tf.random.uniform([batch_size, input_dim])
+  forward = tf.function(lambda t: layer(t))
+  forward(x)  # trace, build and (for xla) compile outside the timed loop
+  start = time.time()
+  for _ in range(steps):
+    y = forward(x)
+  y.numpy()
+  return 1000 * (time.time() - start) / steps
+
+dense_variants = {
+    'keras Dense': lambda: tf.keras.layers.Dense(512, activation='relu'),
+    'FusedDense': lambda: FusedDenseLayer(512, activation='relu'),
+    'FusedDense xla': lambda: FusedDenseLayer(512, activation='relu',
+                                              jit_compile=True),
+}
+
+print("{:>8} {:>14} {:>14} {:>14}".format("batch", *dense_variants))
+for batch_size in [1, 16, 128, 1024, 4096]:
+  timings = [benchmark_dense(make_layer(), batch_size)
+             for make_layer in dense_variants.values()]
+  print("{:>8} {:>12.3f}ms {:>12.3f}ms {:>12.3f}ms".format(batch_size, *timings))
+
 """# Composing model layers
 "Many interesting layer-like things in machine learning models are implemented by composing existing layers. For example, each residual block in a resnet is a composition of convolutions, batch normalizations, and a shortcut. Layers can be nested inside other layers.
 
@@ -132,4 +219,287 @@ my_seq = tf.keras.Sequential([tf.keras.layers.Conv2D(1, (1, 1),
                              tf.keras.layers.BatchNormalization()])
 my_seq(tf.zeros([1, 2, 3, 3]))
 
-my_seq.summary()
\ No newline at end of file
+my_seq.summary()
+
+"""# Folding BatchNormalization into convolutions for inference
+
+at inference time a BatchNormalization layer uses its moving statistics and is only a fixed per-channel affine transform:
+
+y = gamma * (x - moving_mean) / sqrt(moving_variance + epsilon) + beta
+
+when it directly follows a convolution, the scale can be multiplied into the conv kernel and the shift into the conv bias. the folded model has half the layers, no BN ops in the graph and the same outputs up to float rounding. only use the folded model for inference, it can not be trained further as a BN model. a pair is only folded when the conv has no activation (otherwise BN normalizes the activated output) and BN normalizes the conv's channel axis, fold_sequential keeps all other pairs unchanged.
+"""
+
+def can_fold(conv, bn):
+  # the batch norm must follow the linear output of the conv (no activation
+  # in between) and normalize exactly its channel axis
+  if type(conv) is not tf.keras.layers.Conv2D:  # e.g. DepthwiseConv2D
+    return False
+  if conv.activation is not tf.keras.activations.linear:
+    return False
+  axes = bn.axis if isinstance(bn.axis, (list, tuple)) else [bn.axis]
+  channel_axis = 3 if conv.data_format == 'channels_last' else 1
+  return [axis % 4 for axis in axes] == [channel_axis]
+
+def fold_batch_norm(conv, bn):
+  if not can_fold(conv, bn):
+    raise ValueError('can not fold {} into {}'.format(bn.name, conv.name))
+  kernel = conv.kernel
+  bias = conv.bias if conv.use_bias else tf.zeros([kernel.shape[-1]])
+  gamma = bn.gamma if bn.scale else 1.
+  beta = bn.beta if bn.center else 0.
+  scale = gamma * tf.math.rsqrt(bn.moving_variance + bn.epsilon)
+  # kernel is [height, width, in_channels, out_channels], scale broadcasts
+  # over the output channels.
+  return kernel * scale, (bias - bn.moving_mean) * scale + beta
+
+def folded_conv(conv, bn):
+  kernel, bias = fold_batch_norm(conv, bn)
+  config = conv.get_config()
+  config.update(use_bias=True, name=conv.name + '_folded')
+  folded = tf.keras.layers.Conv2D.from_config(config)
+  if conv.data_format == 'channels_last':
+    folded.build(tf.TensorShape([None, None, None, kernel.shape[-2]]))
+  else:
+    folded.build(tf.TensorShape([None, kernel.shape[-2], None, None]))
+  folded.set_weights([kernel.numpy(), bias.numpy()])
+  return folded
+
+class FoldedResnetIdentityBlock(tf.keras.Model):
+  def __init__(self, block):
+    super(FoldedResnetIdentityBlock, self).__init__(name='')
+    self.conv2a = folded_conv(block.conv2a, block.bn2a)
+    self.conv2b = folded_conv(block.conv2b, block.bn2b)
+    self.conv2c = folded_conv(block.conv2c, block.bn2c)
+
+  def call(self, input_tensor, training=False):
+    x = tf.nn.relu(self.conv2a(input_tensor))
+    x = tf.nn.relu(self.conv2b(x))
+    x = self.conv2c(x)
+
+    x += input_tensor
+    return tf.nn.relu(x)
+
+def fold_sequential(model):
+  layers = []
+  for layer in model.layers:
+    if (isinstance(layer, tf.keras.layers.BatchNormalization) and layers
+        and can_fold(layers[-1], layer)):
+      layers[-1] = folded_conv(layers[-1], layer)
+    else:
+      layers.append(layer)
+  folded = tf.keras.Sequential(layers)
+  folded.build(model.input_shape)
+  return folded
+
+"""run a few training steps first, otherwise the moving statistics are still mean 0 / variance 1 and the folding is trivial."""
+
+for _ in range(10):
+  x = tf.random.normal([8, 2, 3, 3], mean=2., stddev=3.)
+  block(x, training=True)
+  my_seq(x, training=True)
+
+folded_block = FoldedResnetIdentityBlock(block)
+folded_seq = fold_sequential(my_seq)
+
+x = tf.random.normal([8, 2, 3, 3], mean=2., stddev=3.)
+print("block max abs diff:", tf.reduce_max(tf.abs(block(x) - folded_block(x))).numpy())
+print("my_seq max abs diff:", tf.reduce_max(tf.abs(my_seq(x) - folded_seq(x))).numpy())
+tf.debugging.assert_near(block(x), folded_block(x), atol=1e-4)
+tf.debugging.assert_near(my_seq(x), folded_seq(x), atol=1e-4)
+
+folded_seq.summary()
+
+"""### Graph size and latency
+
+compare the number of ops in the traced inference graph and the latency on a block of realistic size.
+"""
+
+def inference_graph_ops(model, input_shape):
+  forward = tf.function(lambda t: model(t, training=False))
+  graph = forward.get_concrete_function(
+      tf.TensorSpec(input_shape, tf.float32)).graph
+  return len(graph.get_operations())
+
+def inference_latency(model, x, steps=50):
+  forward = tf.function(lambda t: model(t, training=False))
+  forward(x)
+  start = time.time()
+  for _ in range(steps):
+    y = forward(x)
+  y.numpy()
+  return 1000 * (time.time() - start) / steps
+
+big_block = ResnetIdentityBlock(3, [64, 64, 256])
+x = tf.random.normal([32, 56, 56, 256])
+for _ in range(3):
+  big_block(x, training=True)
+folded_big_block = FoldedResnetIdentityBlock(big_block)
+
+for name, model in [('ResnetIdentityBlock', big_block),
+                    ('FoldedResnetIdentityBlock', folded_big_block)]:
+  print("{:>26}: {:4d} ops, {:8.2f}ms".format(
+      name, inference_graph_ops(model, [None, 56, 56, 256]),
+      inference_latency(model, x)))
+
+x = tf.random.normal([32, 56, 56, 3])
+for name, model in [('my_seq', my_seq), ('folded my_seq', folded_seq)]:
+  print("{:>26}: {:4d} ops, {:8.2f}ms".format(
+      name, inference_graph_ops(model, [None, 56, 56, 3]),
+      inference_latency(model, x)))
+
+"""# Per-layer profiling
+
+model.summary() shows the shapes and parameter counts, but not which layer actually costs the time or the activation memory. LayerProfiler is opt-in: it only patches the `call` of the layers while `profile` runs and restores them afterwards, so it can be applied to any tf.keras.Model (including the custom layers above) without changing it.
+
+for every layer it records
+*   forward time of the layer call
+*   backward time, between the gradient reaching the layer's outputs and leaving its inputs
+*   bytes of the output tensors
+
+timings are only meaningful eagerly, so profile runs the steps outside of tf.function. the inputs are watched by the tape so that the gradient also flows through layers without variables (e.g. RandomInvert). no optimizer step is applied, and the non-trainable weights that training=True updates (the batch norm moving statistics) are saved before and restored after the steps, so the weights are not changed. nested layers are included with recursive=True, their times are then also contained in the time of the parent.
+"""
+
+def sync_devices():
+  # GPU kernels run asynchronously, wait for them before reading the clock.
+  sync = getattr(tf.test.experimental, 'sync_devices', None)
+  if sync is not None and tf.config.list_logical_devices('GPU'):
+    sync()
+
+class LayerProfiler(object):
+  def __init__(self, model, recursive=False):
+    self.model = model
+    if recursive:
+      self.layers = [l for l in model.submodules
+                     if isinstance(l, tf.keras.layers.Layer)]
+    else:
+      self.layers = list(model.layers)
+    self.stats = {}
+
+  def _grad_marker(self, tensor, key, event):
+    @tf.custom_gradient
+    def marker(t):
+      def grad(dy):
+        sync_devices()
+        now = time.perf_counter()
+        if event == 'out':
+          # gradients of all consumers are summed before this runs once.
+          self._grad_events.setdefault((key, event), now)
+        else:
+          self._grad_events[(key, event)] = now
+        return dy
+      return tf.identity(t), grad
+    return marker(tensor)
+
+  def _mark(self, structure, key, event):
+    return tf.nest.map_structure(
+        lambda t: self._grad_marker(t, key, event)
+        if isinstance(t, tf.Tensor) and t.dtype.is_floating else t,
+        structure)
+
+  def _wrap(self, layer):
+    # layer names are not unique (ResnetIdentityBlock is built with name=''),
+    # the stats are keyed by the layer object
+    key = id(layer)
+    original_call = layer.call
+    stats = self.stats.setdefault(key, {
+        'name': layer.name, 'type': layer.__class__.__name__,
+        'forward': [], 'backward': [], 'bytes': 0})
+
+    def call(inputs, *args, **kwargs):
+      inputs = self._mark(inputs, key, 'in')
+      sync_devices()
+      start = time.perf_counter()
+      outputs = original_call(inputs, *args, **kwargs)
+      sync_devices()
+      stats['forward'].append(time.perf_counter() - start)
+      stats['bytes'] = sum(t.shape.num_elements() * t.dtype.size
+                           for t in tf.nest.flatten(outputs)
+                           if isinstance(t, tf.Tensor))
+      return self._mark(outputs, key, 'out')
+
+    # an instance attribute `call` shadows the class method until it is removed
+    instance_call = layer.__dict__.get('call')
+    layer.call = call
+    return instance_call
+
+  def _unwrap(self, layer, instance_call):
+    if instance_call is None:
+      del layer.call
+    else:
+      layer.call = instance_call
+
+  def profile(self, x, y=None, loss_fn=None, steps=10, training=True):
+    # training=True updates e.g. the batch norm moving statistics
+    non_trainable = [w.numpy() for w in self.model.non_trainable_weights]
+    wrapped = [(layer, self._wrap(layer)) for layer in self.layers]
+    try:
+      for _ in range(steps):
+        self._grad_events = {}
+        with tf.GradientTape() as tape:
+          tape.watch(x)
+          outputs = self.model(x, training=training)
+          if loss_fn is None:
+            loss_value = tf.reduce_mean(outputs)
+          else:
+            loss_value = loss_fn(y, outputs)
+        tape.gradient(loss_value, [x] + self.model.trainable_variables)
+        sync_devices()
+        for layer in self.layers:
+          grad_out = self._grad_events.get((id(layer), 'out'))
+          grad_in = self._grad_events.get((id(layer), 'in'))
+          if grad_out is not None and grad_in is not None:
+            self.stats[id(layer)]['backward'].append(grad_in - grad_out)
+    finally:
+      for layer, instance_call in wrapped:
+        self._unwrap(layer, instance_call)
+      for weight, value in zip(self.model.non_trainable_weights, non_trainable):
+        weight.assign(value)
+    return self
+
+  def summary(self, skip_first=1):
+    rows = []
+    for stats in self.stats.values():
+      forward = stats['forward'][skip_first:] or stats['forward']
+      backward = stats['backward'][skip_first:] or stats['backward']
+      forward_ms = 1000 * sum(forward) / max(len(forward), 1)
+      backward_ms = 1000 * sum(backward) / max(len(backward), 1)
+      rows.append((stats['name'], stats['type'], forward_ms, backward_ms,
+                   stats['bytes']))
+    rows.sort(key=lambda row: row[2] + row[3], reverse=True)
+    total_ms = sum(row[2] + row[3] for row in rows) or 1.
+
+    line = "=" * 94
+    print(line)
+    print("{:<32} {:>12} {:>13} {:>15} {:>8}".format(
+        "Layer (type)", "Forward (ms)", "Backward (ms)", "Output bytes",
+        "% time"))
+    print(line)
+    for name, layer_type, forward_ms, backward_ms, num_bytes in rows:
+      print("{:<32} {:>12.3f} {:>13.3f} {:>15,d} {:>7.1f}%".format(
+          "{} ({})".format(name, layer_type)[:32], forward_ms, backward_ms,
+          num_bytes, 100 * (forward_ms + backward_ms) / total_ms))
+    print(line)
+    print("Total output bytes: {:,d}".format(sum(row[4] for row in rows)))
+
+"""profile the resnet block, including the nested conv and batch norm layers:"""
+
+big_block_profiler = LayerProfiler(big_block, recursive=True)
+big_block_profiler.profile(tf.random.normal([32, 56, 56, 256]), steps=5)
+big_block_profiler.summary()
+
+"""and a model built from the custom dense layers with a real loss:"""
+
+dense_model = tf.keras.Sequential([
+    FusedDenseLayer(256, activation='relu'),
+    MyDenseLayer(256),
+    tf.keras.layers.ReLU(),
+    FusedDenseLayer(10),
+])
+dense_model.build([None, 784])
+
+LayerProfiler(dense_model).profile(
+    tf.random.normal([512, 784]),
+    y=tf.random.uniform([512], maxval=10, dtype=tf.int32),
+    loss_fn=tf.keras.losses.SparseCategoricalCrossentropy(from_logits=True),
+    steps=10).summary()
@@ -268,4 +268,152 @@ for i, logits in enumerate(predictions):
   class_idx = tf.math.argmax(logits).numpy()
   p = tf.nn.softmax(logits)[class_idx]
   name = class_names[class_idx]
-  print("Example {} prediction: {} ({:4.1f}%)".format(i, name, 100*p))
\ No newline at end of file
+  print("Example {} prediction: {} ({:4.1f}%)".format(i, name, 100*p))
+
+"""# Compiled training loop
+
+the loop above runs eagerly: every batch goes through python, and `grad` plus `apply_gradients` dispatch one op at a time. for a model with four input features this python overhead is most of the runtime.
+
+wrapping the step in tf.function traces it once into a graph. the logits from the forward pass under the tape are reused for the accuracy metric, so the compiled step does one forward pass per batch instead of two.
+
+with run_epoch_in_graph=True the loop over the dataset is traced as well (autograph turns the `for` over a tf.data.Dataset into a graph loop), so a whole epoch is a single call from python.
+"""
+
+import time
+
+def make_model():
+  return tf.keras.Sequential([
+    tf.keras.layers.Dense(10, activation=tf.nn.relu, input_shape=(4,)),
+    tf.keras.layers.Dense(10, activation=tf.nn.relu),
+    tf.keras.layers.Dense(3)
+  ])
+
+def make_compiled_train_fn(model, optimizer, loss_avg, accuracy,
+                           run_epoch_in_graph=False):
+  @tf.function
+  def train_step(x, y):
+    with tf.GradientTape() as tape:
+      logits = model(x, training=True)
+      loss_value = loss_object(y_true=y, y_pred=logits)
+    grads = tape.gradient(loss_value, model.trainable_variables)
+    optimizer.apply_gradients(zip(grads, model.trainable_variables))
+
+    loss_avg.update_state(loss_value)
+    accuracy.update_state(y, logits)
+
+  def train_epoch(dataset):
+    for x, y in dataset:
+      train_step(x, y)
+
+  if run_epoch_in_graph:
+    return tf.function(train_epoch)
+  return train_epoch
+
+def make_eager_train_fn(model, optimizer, loss_avg, accuracy):
+  # the original loop from above
+  def train_epoch(dataset):
+    for x, y in dataset:
+      loss_value, grads = grad(model, x, y)
+      optimizer.apply_gradients(zip(grads, model.trainable_variables))
+      loss_avg.update_state(loss_value)
+      accuracy.update_state(y, model(x, training=True))
+  return train_epoch
+
+def train(make_train_fn, num_epochs, **kwargs):
+  model = make_model()
+  optimizer = tf.keras.optimizers.SGD(learning_rate=0.01)
+  epoch_loss_avg = tf.keras.metrics.Mean()
+  epoch_accuracy = tf.keras.metrics.SparseCategoricalAccuracy()
+  train_epoch = make_train_fn(model, optimizer, epoch_loss_avg,
+                              epoch_accuracy, **kwargs)
+
+  # first epoch includes the tracing, time the remaining ones
+  start = time.time()
+  for epoch in range(num_epochs):
+    if epoch == 1:
+      start = time.time()
+    epoch_loss_avg.reset_state()
+    epoch_accuracy.reset_state()
+    train_epoch(ds_train_batch)
+  seconds_per_epoch = (time.time() - start) / max(num_epochs - 1, 1)
+  return model, seconds_per_epoch, epoch_loss_avg.result(), epoch_accuracy.result()
+
+"""### Eager vs. compiled benchmark"""
+
+num_epochs = 51
+
+variants = [
+    ('eager', make_eager_train_fn, {}),
+    ('compiled step', make_compiled_train_fn, {}),
+    ('compiled epoch', make_compiled_train_fn, {'run_epoch_in_graph': True}),
+]
+
+eager_seconds = None
+for name, make_train_fn, kwargs in variants:
+  _, seconds, final_loss, final_accuracy = train(make_train_fn, num_epochs,
+                                                 **kwargs)
+  eager_seconds = eager_seconds or seconds
+  print("{:>15}: {:7.2f}ms/epoch ({:5.1f}x), Loss: {:.3f}, Accuracy: {:.3%}".format(
+      name, 1000 * seconds, eager_seconds / seconds, final_loss,
+      final_accuracy))
+
+"""# In-memory trainer
+
+the penguins dataset has a few hundred rows, so it easily fits into memory. streaming it through `shuffle().batch()` still pays the tf.data overhead for every single element.
+
+fit_in_memory keeps the whole feature and label tensors resident. every epoch is one tf.function call: the rows are shuffled by a random permutation of the indices inside the graph and the batches are gathered by slices of that permutation. use it for datasets that comfortably fit in (device) memory, roughly below 1M rows. features can be a tensor or a dict of tensors.
+"""
+
+def fit_in_memory(model, optimizer, loss_fn, features, labels, epochs,
+                  batch_size=32, seed=None, verbose=True):
+  features = tf.nest.map_structure(tf.convert_to_tensor, features)
+  labels = tf.convert_to_tensor(labels)
+  num_rows = int(labels.shape[0])
+  num_batches = -(-num_rows // batch_size)
+
+  @tf.function
+  def train_epoch():
+    indices = tf.random.shuffle(tf.range(num_rows), seed=seed)
+    total_loss = tf.constant(0.)
+    for i in tf.range(num_batches):
+      batch_indices = indices[i * batch_size:(i + 1) * batch_size]
+      x = tf.nest.map_structure(lambda t: tf.gather(t, batch_indices), features)
+      y = tf.gather(labels, batch_indices)
+      with tf.GradientTape() as tape:
+        loss_value = loss_fn(y, model(x, training=True))
+      grads = tape.gradient(loss_value, model.trainable_variables)
+      optimizer.apply_gradients(zip(grads, model.trainable_variables))
+      total_loss += loss_value
+    return total_loss / num_batches
+
+  history = {'loss': [], 'seconds': []}
+  for epoch in range(epochs):
+    start = time.time()
+    epoch_loss = train_epoch().numpy()
+    history['loss'].append(epoch_loss)
+    history['seconds'].append(time.time() - start)
+    if verbose and epoch % 50 == 0:
+      print("Epoch {:03d}: Loss: {:.3f}".format(epoch, epoch_loss))
+  return history
+
+"""load the whole training split as two tensors:"""
+
+num_train_examples = sum(1 for _ in ds_train)
+train_features, train_labels = next(iter(ds_train.batch(num_train_examples)))
+
+in_memory_model = make_model()
+history = fit_in_memory(in_memory_model,
+                        tf.keras.optimizers.SGD(learning_rate=0.01),
+                        loss_object, train_features, train_labels,
+                        epochs=num_epochs, batch_size=32)
+
+in_memory_accuracy = tf.keras.metrics.SparseCategoricalAccuracy()
+in_memory_accuracy(train_labels, in_memory_model(train_features, training=False))
+
+# first epoch includes the tracing
+in_memory_seconds = sum(history['seconds'][1:]) / (num_epochs - 1)
+_, compiled_seconds, _, _ = train(make_compiled_train_fn, num_epochs,
+                                  run_epoch_in_graph=True)
+print("tf.data compiled epoch: {:7.2f}ms/epoch".format(1000 * compiled_seconds))
+print("in-memory epoch:        {:7.2f}ms/epoch, Accuracy: {:.3%}".format(
+    1000 * in_memory_seconds, in_memory_accuracy.result()))
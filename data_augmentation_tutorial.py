@@ -193,7 +193,7 @@ class RandomInvert(layers.Layer):
     self.factor = factor
 
   def call(self, x):
-    return random_invert_img(x)
+    return random_invert_img(x, self.factor)
 
 _ = plt.imshow(RandomInvert()(image)[0])
 
@@ -400,4 +400,663 @@ test_ds = (
     .map(resize_and_rescale, num_parallel_calls=AUTOTUNE)
     .batch(batch_size)
     .prefetch(AUTOTUNE)
-)
\ No newline at end of file
+)
+
+"""##Batched augmentation
+augment runs once per image before .batch(): pad, crop, brightness and the seed split are each launched for every single image, thousands of small kernels per epoch.
+
+augment_batch does the same transformations on a whole batch at once:
+*  images are resized per image (they have different sizes), then batched
+*  padding, cropping, brightness and clipping are one op each for the whole batch
+*  every sample still gets its own crop offset and brightness delta, drawn from its own seed
+
+the random values are derived exactly like tf.image.stateless_random_crop and tf.image.stateless_random_brightness do it, so with the same per-sample seeds the output is identical to augment. Only these scalar draws are vectorized over the seeds, the image ops never loop over the batch.
+"""
+
+def batch_seeds(batch_seed, batch_size):
+  # One seed of shape (2,) for the batch -> (batch_size, 2) per-sample seeds.
+  return tf.random.experimental.stateless_split(batch_seed, num=batch_size)
+
+def augment_batch(images, labels, seeds, max_delta=0.5):
+  images = tf.image.resize_with_crop_or_pad(images, IMG_SIZE + 6, IMG_SIZE + 6)
+  padded_size = tf.shape(images)[1:]
+  crop_size = tf.constant([IMG_SIZE, IMG_SIZE, 3])
+  limit = padded_size - crop_size + 1
+
+  def draw(seed):
+    # Same draws as stateless_random_crop and stateless_random_brightness.
+    offset = tf.random.stateless_uniform(
+        [3], seed=seed, maxval=tf.int32.max, dtype=tf.int32) % limit
+    new_seed = tf.random.experimental.stateless_split(seed, num=1)[0, :]
+    delta = tf.random.stateless_uniform(
+        [], seed=new_seed, minval=-max_delta, maxval=max_delta)
+    return offset, delta
+
+  offsets, deltas = tf.vectorized_map(draw, seeds)
+
+  # Random crop, per sample offsets, via gathers of the rows and columns.
+  rows = offsets[:, 0:1] + tf.range(IMG_SIZE)
+  cols = offsets[:, 1:2] + tf.range(IMG_SIZE)
+  images = tf.gather(images, rows, axis=1, batch_dims=1)
+  images = tf.gather(images, cols, axis=2, batch_dims=1)
+
+  # Random brightness.
+  images = images + deltas[:, tf.newaxis, tf.newaxis, tf.newaxis]
+  images = tf.clip_by_value(images, 0, 1)
+  return images, labels
+
+"""with the counter seeds batched along with the images, the batched pipeline produces exactly the same images as the per image one:"""
+
+def make_per_image_ds(ds):
+  counter = tf.data.experimental.Counter()
+  return (tf.data.Dataset.zip((ds, (counter, counter)))
+          .map(augment, num_parallel_calls=AUTOTUNE)
+          .batch(batch_size)
+          .prefetch(AUTOTUNE))
+
+def make_batched_ds(ds):
+  counter = tf.data.experimental.Counter()
+  seeds = tf.data.Dataset.zip((counter, counter)).map(lambda a, b: tf.stack([a, b]))
+  return (tf.data.Dataset.zip((ds.map(resize_and_rescale,
+                                      num_parallel_calls=AUTOTUNE), seeds))
+          .batch(batch_size)
+          .map(lambda image_label, seed: augment_batch(*image_label, seed),
+               num_parallel_calls=AUTOTUNE)
+          .prefetch(AUTOTUNE))
+
+for (per_image, _), (batched, _) in zip(make_per_image_ds(train_datasets).take(3),
+                                        make_batched_ds(train_datasets).take(3)):
+  tf.debugging.assert_near(per_image, batched, atol=1e-6)
+
+"""for a new random batch from a single seed, derive the per-sample seeds with batch_seeds:"""
+
+images, labels = next(iter(train_datasets.map(resize_and_rescale).batch(9)))
+augmented, _ = augment_batch(images, labels, batch_seeds([7, 0], 9))
+
+plt.figure(figsize=(10, 10))
+for i in range(9):
+  ax = plt.subplot(3, 3, i + 1)
+  plt.imshow(augmented[i])
+  plt.axis("off")
+
+"""###Throughput
+count images/sec over one pass of the training split, the first batches include tracing, so they are skipped
+"""
+
+import time
+
+def images_per_sec(ds, warmup=5):
+  num_images = 0
+  for i, (images, labels) in enumerate(ds):
+    if i == warmup:
+      start = time.time()
+      num_images = 0
+    num_images += int(tf.shape(images)[0])
+  return num_images / (time.time() - start)
+
+print("per image: {:8.1f} images/sec".format(
+    images_per_sec(make_per_image_ds(train_datasets))))
+print("batched:   {:8.1f} images/sec".format(
+    images_per_sec(make_batched_ds(train_datasets))))
+
+"""##Caching the deterministic preprocessing
+augment decodes, resizes and rescales every image again in every epoch, although only the crop and the brightness are random. the deterministic part can be computed once and cached (in memory or in a file), only the random part has to run after the cache.
+
+the pipeline is described as a list of stages `fn(image, label, seed)`. cached_augmentation_pipeline traces every stage and checks its graph for random ops, all stages up to the first random one are deterministic and are mapped before the `.cache()`, the rest after it. since a Counter restarts with every new iterator (every epoch in model.fit), the seeds after the cache come from a tf.random.Generator instead.
+"""
+
+def is_deterministic(stage, element_spec):
+  image_spec, label_spec = element_spec
+  graph = tf.function(stage).get_concrete_function(
+      image_spec, label_spec, tf.TensorSpec([2], tf.int64)).graph
+  return not any('Random' in op.type or 'Rng' in op.type
+                 for op in graph.get_operations())
+
+def cached_augmentation_pipeline(ds, stages, cache_path='', shuffle=1000,
+                                 seed=123):
+  unused_seed = tf.constant([0, 0], tf.int64)
+  split = 0
+  for stage in stages:
+    if not is_deterministic(stage, ds.element_spec):
+      break
+    ds = ds.map(lambda x, y, stage=stage: stage(x, y, unused_seed),
+                num_parallel_calls=AUTOTUNE)
+    split += 1
+  print("cached stages:", [stage.__name__ for stage in stages[:split]])
+  print("random stages:", [stage.__name__ for stage in stages[split:]])
+
+  # cache_path='' keeps the cache in memory, otherwise it is written to files.
+  ds = ds.cache(cache_path)
+  if shuffle:
+    ds = ds.shuffle(shuffle)
+
+  random_stages = stages[split:]
+  if random_stages:
+    rng = tf.random.Generator.from_seed(seed, alg='philox')
+
+    def apply_random_stages(x, y):
+      seeds = tf.random.experimental.stateless_split(
+          rng.make_seeds(2)[0], num=len(random_stages))
+      for i, stage in enumerate(random_stages):
+        x, y = stage(x, y, seeds[i])
+      return x, y
+
+    ds = ds.map(apply_random_stages, num_parallel_calls=AUTOTUNE)
+  return ds.batch(batch_size).prefetch(AUTOTUNE)
+
+"""augment split into stages:"""
+
+def resize_rescale_stage(image, label, seed):
+  return resize_and_rescale(image, label)
+
+def random_crop_stage(image, label, seed):
+  image = tf.image.resize_with_crop_or_pad(image, IMG_SIZE + 6, IMG_SIZE + 6)
+  image = tf.image.stateless_random_crop(
+      image, size=[IMG_SIZE, IMG_SIZE, 3], seed=seed)
+  return image, label
+
+def random_brightness_stage(image, label, seed):
+  image = tf.image.stateless_random_brightness(image, max_delta=0.5, seed=seed)
+  return tf.clip_by_value(image, 0, 1), label
+
+cached_train_ds = cached_augmentation_pipeline(
+    train_datasets,
+    [resize_rescale_stage, random_crop_stage, random_brightness_stage])
+
+"""compare the time per epoch with the uncached pipeline using the Generator seeds from above. the first epoch of the cached pipeline fills the cache, the following ones only run the random stages."""
+
+def epoch_seconds(ds, epochs=3):
+  seconds = []
+  for _ in range(epochs):
+    start = time.time()
+    for _ in ds:
+      pass
+    seconds.append(time.time() - start)
+  return seconds
+
+uncached_train_ds = (
+    train_datasets
+    .shuffle(1000)
+    .map(f, num_parallel_calls=AUTOTUNE)
+    .batch(batch_size)
+    .prefetch(AUTOTUNE)
+)
+
+for name, ds in [('uncached', uncached_train_ds), ('cached', cached_train_ds)]:
+  print("{:>8}: ".format(name) + ", ".join(
+      "{:.2f}s".format(s) for s in epoch_seconds(ds)))
+
+"""##Per sample random augmentation layers
+random_invert_img decides with a single python `if` for the whole input: applied to a batch it inverts either every image or none. the layers below draw one decision per sample and select with a masked tf.where, so they are correct on batches, trace into graphs without python control flow and work both in a tf.data map and inside a model.
+
+every layer applies its transform to a sample with probability `factor`. the random values come from a tf.random.Generator owned by the layer, `seed` makes them reproducible. `value_range` is the maximum pixel value, 255 for uint8 style images, 1 after rescaling.
+"""
+
+class PerSampleRandomLayer(layers.Layer):
+  def __init__(self, factor=0.5, value_range=255., seed=None, **kwargs):
+    super().__init__(**kwargs)
+    self.factor = factor
+    self.value_range = value_range
+    self.seed = seed
+    if seed is None:
+      self._rng = tf.random.Generator.from_non_deterministic_state()
+    else:
+      self._rng = tf.random.Generator.from_seed(seed)
+
+  def transform(self, images, seed):
+    raise NotImplementedError
+
+  def call(self, images, training=True):
+    if not training:
+      return images
+    images = tf.convert_to_tensor(images)
+    unbatched = images.shape.rank == 3
+    if unbatched:
+      images = images[tf.newaxis]
+    images = tf.cast(images, tf.float32)
+
+    mask_seed, transform_seed = tf.unstack(self._rng.make_seeds(2), axis=1)
+    apply = tf.random.stateless_uniform(
+        [tf.shape(images)[0]], seed=mask_seed) < self.factor
+    outputs = tf.where(apply[:, tf.newaxis, tf.newaxis, tf.newaxis],
+                       self.transform(images, transform_seed), images)
+    if unbatched:
+      outputs = outputs[0]
+    return outputs
+
+  def get_config(self):
+    config = super().get_config()
+    config.update({'factor': self.factor, 'value_range': self.value_range,
+                   'seed': self.seed})
+    return config
+
+class PerSampleRandomInvert(PerSampleRandomLayer):
+  def transform(self, images, seed):
+    return self.value_range - images
+
+class PerSampleRandomSolarize(PerSampleRandomLayer):
+  def __init__(self, threshold=0.5, **kwargs):
+    super().__init__(**kwargs)
+    # threshold as a fraction of value_range
+    self.threshold = threshold
+
+  def transform(self, images, seed):
+    return tf.where(images >= self.threshold * self.value_range,
+                    self.value_range - images, images)
+
+  def get_config(self):
+    config = super().get_config()
+    config.update({'threshold': self.threshold})
+    return config
+
+class PerSampleRandomBrightness(PerSampleRandomLayer):
+  def __init__(self, max_delta=0.2, **kwargs):
+    super().__init__(**kwargs)
+    # max_delta as a fraction of value_range
+    self.max_delta = max_delta
+
+  def transform(self, images, seed):
+    delta = tf.random.stateless_uniform(
+        [tf.shape(images)[0], 1, 1, 1], seed=seed,
+        minval=-self.max_delta, maxval=self.max_delta)
+    return tf.clip_by_value(images + delta * self.value_range,
+                            0, self.value_range)
+
+  def get_config(self):
+    config = super().get_config()
+    config.update({'max_delta': self.max_delta})
+    return config
+
+class PerSampleRandomChannelShuffle(PerSampleRandomLayer):
+  def transform(self, images, seed):
+    shape = tf.shape(images)
+    # argsort of uniform noise gives one random permutation per sample
+    permutations = tf.argsort(
+        tf.random.stateless_uniform([shape[0], shape[3]], seed=seed), axis=-1)
+    return tf.gather(images, permutations, axis=3, batch_dims=1)
+
+"""the layers on a batch of 9 copies of the image: now every sample decides on its own"""
+
+per_sample_augmentation = tf.keras.Sequential([
+  PerSampleRandomInvert(factor=0.3, seed=1),
+  PerSampleRandomSolarize(factor=0.3, seed=2),
+  PerSampleRandomBrightness(factor=0.5, seed=3),
+  PerSampleRandomChannelShuffle(factor=0.3, seed=4),
+])
+
+augmented = per_sample_augmentation(tf.repeat(image[tf.newaxis], 9, axis=0))
+
+plt.figure(figsize=(10, 10))
+for i in range(9):
+  ax = plt.subplot(3, 3, i + 1)
+  plt.imshow(augmented[i].numpy().astype("uint8"))
+  plt.axis("off")
+
+"""###Checks
+*  about `factor` of the samples are changed
+*  the same seed gives the same output
+*  not training -> identity
+*  the layers trace under tf.data map
+"""
+
+images = tf.random.uniform([1000, 8, 8, 3], maxval=255.)
+for layer_class in [PerSampleRandomInvert, PerSampleRandomSolarize,
+                    PerSampleRandomBrightness, PerSampleRandomChannelShuffle]:
+  outputs = layer_class(factor=0.3, seed=42)(images)
+  changed = tf.reduce_any(tf.not_equal(outputs, images), axis=[1, 2, 3])
+  fraction = tf.reduce_mean(tf.cast(changed, tf.float32)).numpy()
+  assert 0.2 < fraction < 0.4, (layer_class.__name__, fraction)
+
+  tf.debugging.assert_equal(outputs, layer_class(factor=0.3, seed=42)(images))
+  tf.debugging.assert_equal(images, layer_class(seed=42)(images, training=False))
+
+  ds = tf.data.Dataset.from_tensor_slices(images).batch(100)
+  ds = ds.map(lambda x, layer=layer_class(seed=42): layer(x, training=True))
+  assert next(iter(ds)).shape == (100, 8, 8, 3)
+
+"""###Throughput
+images/sec of each layer on batches of 180x180 images, once as a tf.data map and once inside a model called in a tf.function
+"""
+
+def layer_images_per_sec(layer, in_model, num_batches=50):
+  images = tf.random.uniform([batch_size, IMG_SIZE, IMG_SIZE, 3], maxval=255.)
+  if in_model:
+    forward = tf.function(lambda x: layer(x, training=True))
+    forward(images)
+    start = time.time()
+    for _ in range(num_batches):
+      outputs = forward(images)
+    outputs.numpy()
+  else:
+    ds = (tf.data.Dataset.from_tensors(images).repeat(num_batches)
+          .map(lambda x: layer(x, training=True), num_parallel_calls=AUTOTUNE)
+          .prefetch(AUTOTUNE))
+    start = time.time()
+    for _ in ds:
+      pass
+  return num_batches * batch_size / (time.time() - start)
+
+for layer_class in [PerSampleRandomInvert, PerSampleRandomSolarize,
+                    PerSampleRandomBrightness, PerSampleRandomChannelShuffle]:
+  print("{:>30}: tf.data {:9.1f} images/sec, in model {:9.1f} images/sec".format(
+      layer_class.__name__,
+      layer_images_per_sec(layer_class(seed=0), in_model=False),
+      layer_images_per_sec(layer_class(seed=0), in_model=True)))
+
+"""##Benchmark of the augmentation variants
+the tutorial shows four ways to augment:
+1.  keras preprocessing layers inside the model
+2.  keras preprocessing layers in a tf.data map
+3.  tf.image with a Counter seed
+4.  tf.image with a tf.random.Generator seed
+
+run_augmentation_benchmark runs every variant on synthetic uint8 images (so no download is needed and the decode cost is equal for all) at each target size and reports images/sec, the CPU utilization (process cpu time / wall time, 1.0 = one busy core) and the memory (resident set size) after every epoch. psutil is used for the memory if it is installed, otherwise the peak RSS from the resource module.
+"""
+
+import os
+import resource
+
+try:
+  import psutil
+except ImportError:
+  psutil = None
+
+def memory_mb():
+  if psutil is not None:
+    return psutil.Process().memory_info().rss / 2**20
+  # ru_maxrss is the peak, in KB on linux
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+def make_keras_augmentation(size):
+  return tf.keras.Sequential([
+    layers.Resizing(size, size),
+    layers.Rescaling(1./255),
+    layers.RandomFlip("horizontal_and_vertical"),
+    layers.RandomRotation(0.2),
+  ])
+
+def make_tf_image_augment(size):
+  # augment from above for an arbitrary target size
+  def sized_augment(image_label, seed):
+    image, label = image_label
+    image = tf.image.resize(tf.cast(image, tf.float32), [size, size]) / 255.0
+    image = tf.image.resize_with_crop_or_pad(image, size + 6, size + 6)
+    new_seed = tf.random.experimental.stateless_split(seed, num=1)[0, :]
+    image = tf.image.stateless_random_crop(image, size=[size, size, 3], seed=seed)
+    image = tf.image.stateless_random_brightness(
+        image, max_delta=0.5, seed=new_seed)
+    return tf.clip_by_value(image, 0, 1), label
+  return sized_augment
+
+def make_benchmark_variants(ds, size):
+  keras_in_model = make_keras_augmentation(size)
+  keras_in_data = make_keras_augmentation(size)
+  sized_augment = make_tf_image_augment(size)
+  bench_rng = tf.random.Generator.from_seed(123, alg='philox')
+
+  def generator_augment(x, y):
+    return sized_augment((x, y), bench_rng.make_seeds(2)[0])
+
+  counter = tf.data.experimental.Counter()
+  return {
+    # the in model variant augments the batches in the (compiled) forward pass
+    'keras in model': (
+        ds.batch(batch_size).prefetch(AUTOTUNE),
+        tf.function(lambda x: keras_in_model(x, training=True))),
+    'keras in tf.data': (
+        ds.batch(batch_size)
+          .map(lambda x, y: (keras_in_data(x, training=True), y),
+               num_parallel_calls=AUTOTUNE)
+          .prefetch(AUTOTUNE),
+        None),
+    'tf.image Counter': (
+        tf.data.Dataset.zip((ds, (counter, counter)))
+          .map(sized_augment, num_parallel_calls=AUTOTUNE)
+          .batch(batch_size)
+          .prefetch(AUTOTUNE),
+        None),
+    'tf.image Generator': (
+        ds.map(generator_augment, num_parallel_calls=AUTOTUNE)
+          .batch(batch_size)
+          .prefetch(AUTOTUNE),
+        None),
+  }
+
+def run_augmentation_benchmark(image_sizes=(180, 224), num_images=512,
+                               source_size=256, epochs=3):
+  source = tf.random.uniform([num_images, source_size, source_size, 3],
+                             maxval=256, dtype=tf.int32)
+  ds = tf.data.Dataset.from_tensor_slices(
+      (tf.cast(source, tf.uint8), tf.zeros([num_images], tf.int64)))
+
+  results = []
+  for size in image_sizes:
+    for name, (variant_ds, in_model) in make_benchmark_variants(ds, size).items():
+      for epoch in range(epochs):
+        cpu_start = sum(os.times()[:2])
+        start = time.time()
+        for images, labels in variant_ds:
+          if in_model is not None:
+            images = in_model(images)
+        images.numpy()
+        wall = time.time() - start
+        cpu = sum(os.times()[:2]) - cpu_start
+        results.append((size, name, epoch, num_images / wall, cpu / wall,
+                        memory_mb()))
+
+  print("{:>5} {:>20} {:>6} {:>12} {:>8} {:>10}".format(
+      "size", "variant", "epoch", "images/sec", "cpu", "memory"))
+  for size, name, epoch, throughput, cpu, memory in results:
+    print("{:>5} {:>20} {:>6} {:>12.1f} {:>8.2f} {:>8.0f}MB".format(
+        size, name, epoch, throughput, cpu, memory))
+  return results
+
+"""the first epoch of every variant includes the tracing."""
+
+benchmark_results = run_augmentation_benchmark()
+
+"""##Multi process augmentation
+augmentation written in python (numpy, PIL, cv2, ...) has to be wrapped with tf.numpy_function, and then it runs under the GIL: num_parallel_calls does not help, only one python function runs at a time.
+
+SharedMemoryAugmentationPool runs such a function in separate worker processes:
+*  the batches are exchanged through two shared memory ring buffers (inputs and outputs) with `num_slots` slots each. a batch is copied once into its input slot, the workers read and write the slots directly, nothing but the slot index is sent through the queues and no image data is pickled
+*  at most `num_slots` batches are in flight, which bounds the prefetch and the memory
+*  every batch gets its own seed from (seed, epoch, batch index), the result does not depend on which worker processed it and every epoch is augmented differently
+*  batches are returned in order, as a tf.data.Dataset
+
+`augment_fn(images, rng)` gets a uint8 numpy batch and a numpy Generator and returns the augmented batch of shape `output_shape`. workers are forked by default, since functions defined in a notebook can not be pickled for the 'spawn' start method. the workers must not use tensorflow.
+"""
+
+import collections
+import multiprocessing
+import queue
+import traceback
+from multiprocessing import shared_memory
+
+def _augmentation_worker(augment_fn, input_name, input_shape, input_dtype,
+                         output_name, output_shape, output_dtype, tasks, done):
+  input_shm = shared_memory.SharedMemory(name=input_name)
+  output_shm = shared_memory.SharedMemory(name=output_name)
+  inputs = np.ndarray(input_shape, dtype=input_dtype, buffer=input_shm.buf)
+  outputs = np.ndarray(output_shape, dtype=output_dtype, buffer=output_shm.buf)
+  try:
+    while True:
+      task = tasks.get()
+      if task is None:
+        break
+      slot, n, seed = task
+      try:
+        outputs[slot, :n] = augment_fn(inputs[slot, :n], np.random.default_rng(seed))
+      except Exception:
+        done.put((slot, traceback.format_exc()))
+      else:
+        done.put((slot, None))
+  finally:
+    del inputs, outputs
+    input_shm.close()
+    output_shm.close()
+
+class SharedMemoryAugmentationPool(object):
+  def __init__(self, augment_fn, batch_shape, output_shape=None,
+               input_dtype=np.uint8, output_dtype=np.float32,
+               num_workers=None, num_slots=None, seed=0,
+               start_method='fork'):
+    self.num_workers = num_workers or os.cpu_count()
+    self.num_slots = num_slots or 2 * self.num_workers
+    self.batch_shape = tuple(batch_shape)
+    self.output_shape = tuple(output_shape or batch_shape)
+    self.input_dtype = np.dtype(input_dtype)
+    self.output_dtype = np.dtype(output_dtype)
+    self.seed = seed
+
+    input_shape = (self.num_slots,) + self.batch_shape
+    output_shape = (self.num_slots,) + self.output_shape
+    self._input_shm = shared_memory.SharedMemory(
+        create=True, size=int(np.prod(input_shape)) * self.input_dtype.itemsize)
+    self._output_shm = shared_memory.SharedMemory(
+        create=True, size=int(np.prod(output_shape)) * self.output_dtype.itemsize)
+    self._inputs = np.ndarray(input_shape, dtype=self.input_dtype,
+                              buffer=self._input_shm.buf)
+    self._outputs = np.ndarray(output_shape, dtype=self.output_dtype,
+                               buffer=self._output_shm.buf)
+
+    context = multiprocessing.get_context(start_method)
+    self._tasks = context.Queue()
+    self._done = context.Queue()
+    self._workers = [
+        context.Process(
+            target=_augmentation_worker,
+            args=(augment_fn, self._input_shm.name, input_shape,
+                  self.input_dtype, self._output_shm.name, output_shape,
+                  self.output_dtype, self._tasks, self._done),
+            daemon=True)
+        for _ in range(self.num_workers)]
+    for worker in self._workers:
+      worker.start()
+    # slots handed to the workers and not reported back yet
+    self._outstanding = set()
+    # counts the iterators (epochs), part of every batch seed
+    self._epoch = 0
+
+  def _receive(self, timeout=1.0):
+    while True:
+      try:
+        slot, error = self._done.get(timeout=timeout)
+      except queue.Empty:
+        dead = [w.pid for w in self._workers if not w.is_alive()]
+        if dead:
+          raise RuntimeError('augmentation workers died: {}'.format(dead))
+        continue
+      self._outstanding.discard(slot)
+      return slot, error
+
+  def _generate(self, batches):
+    # an iterator abandoned early (e.g. after .take()) can leave batches in
+    # the workers, wait for them before their slots are reused
+    while self._outstanding:
+      self._receive()
+    epoch = self._epoch
+    self._epoch += 1
+
+    free_slots = collections.deque(range(self.num_slots))
+    in_flight = collections.deque()
+    finished = set()
+
+    def wait_for(slot):
+      while slot not in finished:
+        done_slot, error = self._receive()
+        if error is not None:
+          raise RuntimeError('augment_fn failed in a worker:\n' + error)
+        finished.add(done_slot)
+      finished.remove(slot)
+
+    for index, (images, labels) in enumerate(batches):
+      if not free_slots:
+        # ring buffer full, hand out the oldest batch first
+        slot, n, oldest_labels = in_flight.popleft()
+        wait_for(slot)
+        # copy: the slot is reused while the batch may still be queued downstream
+        yield self._outputs[slot, :n].copy(), oldest_labels
+        free_slots.append(slot)
+      slot = free_slots.popleft()
+      n = len(images)
+      self._inputs[slot, :n] = images
+      self._tasks.put((slot, n, (self.seed, epoch, index)))
+      self._outstanding.add(slot)
+      in_flight.append((slot, n, labels))
+
+    while in_flight:
+      slot, n, labels = in_flight.popleft()
+      wait_for(slot)
+      yield self._outputs[slot, :n].copy(), labels
+      free_slots.append(slot)
+
+  def dataset(self, ds):
+    """ds yields (uint8 images, labels) batches of at most batch_shape."""
+    return tf.data.Dataset.from_generator(
+        lambda: self._generate(ds.as_numpy_iterator()),
+        output_signature=(
+            tf.TensorSpec((None,) + self.output_shape[1:],
+                          tf.as_dtype(self.output_dtype)),
+            ds.element_spec[1]))
+
+  def close(self):
+    for _ in self._workers:
+      self._tasks.put(None)
+    for worker in self._workers:
+      worker.join()
+    del self._inputs, self._outputs
+    self._input_shm.close()
+    self._input_shm.unlink()
+    self._output_shm.close()
+    self._output_shm.unlink()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
+
+"""a (deliberately) python heavy augmentation, working image by image in numpy:"""
+
+def numpy_augment(images, rng):
+  outputs = np.empty(images.shape, dtype=np.float32)
+  for i, image in enumerate(images):
+    image = image.astype(np.float32) / 255.
+    if rng.random() < 0.5:
+      image = image[:, ::-1]
+    image = np.rot90(image, k=rng.integers(4))
+    contrast = rng.uniform(0.7, 1.3)
+    image = (image - image.mean()) * contrast + image.mean()
+    image = image + rng.normal(0., 0.02, size=image.shape)
+    outputs[i] = np.clip(image, 0., 1.)
+  return outputs
+
+uint8_batches = (
+    train_datasets
+    .map(lambda x, y: (tf.cast(tf.image.resize(x, [IMG_SIZE, IMG_SIZE]), tf.uint8), y),
+         num_parallel_calls=AUTOTUNE)
+    .batch(batch_size)
+    .cache())
+for _ in uint8_batches:
+  pass
+
+"""baseline: the same function with tf.numpy_function, limited by the GIL"""
+
+def numpy_function_augment(images, labels):
+  images = tf.numpy_function(
+      lambda x: numpy_augment(x, np.random.default_rng()), [images], tf.float32)
+  return tf.ensure_shape(images, [None, IMG_SIZE, IMG_SIZE, 3]), labels
+
+print("{:>28}: {:8.1f} images/sec".format("tf.numpy_function", images_per_sec(
+    uint8_batches.map(numpy_function_augment, num_parallel_calls=AUTOTUNE)
+    .prefetch(AUTOTUNE), warmup=2)))
+
+for num_workers in sorted({1, 2, 4, os.cpu_count()}):
+  with SharedMemoryAugmentationPool(
+      numpy_augment, [batch_size, IMG_SIZE, IMG_SIZE, 3],
+      num_workers=num_workers) as pool:
+    print("{:>28}: {:8.1f} images/sec".format(
+        "{} worker processes".format(num_workers),
+        images_per_sec(pool.dataset(uint8_batches).prefetch(AUTOTUNE),
+                       warmup=2)))
@@ -62,6 +62,130 @@ Tokenize with one-hot encoding using Textvectorization module. Tokens are limite
 text_vectorization = tf.keras.layers.TextVectorization(output_mode='tf_idf', max_tokens=1200, output_sequence_length=None)
 text_vectorization.adapt(data=train_data.map(lambda x: x['text']))
 
+"""adapt keeps exact counts for every token on the client. `parallel_adapt` counts tokens in parallel tf.data map calls, merges them into a heavy-hitters sketch with bounded memory and recounts only the candidates exactly, it also computes the document frequencies for the tf_idf weights
+"""
+
+import time
+import warnings
+
+def _prune_sketch(tokens, counts, capacity):
+  # weighted Misra-Gries step: subtract the (capacity + 1)-th largest count
+  # from every entry and drop what falls to zero. returns the pruned sketch
+  # and the amount subtracted, a token missing from the sketch can not have
+  # been counted more often than the sum of these amounts
+  threshold = tf.math.top_k(counts, k=capacity + 1).values[-1]
+  keep = counts > threshold
+  return (tf.boolean_mask(tokens, keep), tf.boolean_mask(counts, keep) - threshold,
+          int(threshold))
+
+def parallel_adapt(layer, text_ds, batch_size=4096, sketch_factor=8):
+  """Sets the vocabulary of a TextVectorization layer like `adapt`, with bounded memory.
+
+  `layer` must not be adapted yet, its standardize and split are taken from
+  its config. Pass 1 counts tokens batch by batch in parallel tf.data map
+  calls and merges the counts into a heavy-hitters sketch of
+  `sketch_factor * max_tokens` entries (vectorized, with tf.unique and a
+  segment sum). Pass 2 recounts the sketch candidates exactly, so the
+  vocabulary is ordered and cut like `adapt` does: by count, ties broken by
+  token, both descending. A warning is issued when the sketch may have missed
+  a token of the top-k. With max_tokens=None nothing is pruned.
+  """
+  config = layer.get_config()
+  standardize = config['standardize']
+  if standardize == 'lower_and_strip_punctuation':
+    standardize = lambda text: tf.strings.regex_replace(
+        tf.strings.lower(text), r'[!"#$%&()\*\+,-\./:;<=>?@\[\\\]^_`{|}~\']', '')
+  elif standardize is None:
+    standardize = lambda text: text
+  elif not callable(standardize):
+    raise ValueError('unsupported standardize: {!r}'.format(standardize))
+  if config['split'] != 'whitespace':
+    raise ValueError('unsupported split: {!r}'.format(config['split']))
+
+  if config['max_tokens'] is None:
+    num_tokens = capacity = None
+  else:
+    num_tokens = config['max_tokens'] - len(layer.get_vocabulary())
+    capacity = sketch_factor * num_tokens
+
+  if text_ds.element_spec.shape.rank:
+    text_ds = text_ds.unbatch()
+  tokens_ds = text_ds.batch(batch_size).map(
+      lambda text: tf.strings.split(standardize(text)),
+      num_parallel_calls=tf.data.AUTOTUNE, deterministic=False)
+
+  # pass 1: heavy hitters
+  def batch_counts(tokens):
+    unique, _, counts = tf.unique_with_counts(tokens.flat_values,
+                                              out_idx=tf.int64)
+    return unique, counts
+
+  sketch_tokens = tf.constant([], dtype=tf.string)
+  sketch_counts = tf.constant([], dtype=tf.int64)
+  subtracted = 0
+  counted = tokens_ds.map(batch_counts, num_parallel_calls=tf.data.AUTOTUNE,
+                          deterministic=False).prefetch(tf.data.AUTOTUNE)
+  for unique, counts in counted:
+    sketch_tokens, index = tf.unique(tf.concat([sketch_tokens, unique], 0))
+    sketch_counts = tf.math.unsorted_segment_sum(
+        tf.concat([sketch_counts, counts], 0), index, tf.size(sketch_tokens))
+    if capacity is not None and len(sketch_tokens) > 2 * capacity:
+      sketch_tokens, sketch_counts, threshold = _prune_sketch(
+          sketch_tokens, sketch_counts, capacity)
+      subtracted += threshold
+  candidates = sketch_tokens.numpy()
+
+  # pass 2: exact token and document counts of the candidates
+  size = len(candidates)
+  table = tf.lookup.StaticHashTable(
+      tf.lookup.KeyValueTensorInitializer(
+          sketch_tokens, tf.range(size, dtype=tf.int64)),
+      default_value=-1)
+
+  def candidate_counts(tokens):
+    ids = table.lookup(tokens.flat_values)
+    known = ids >= 0
+    ids = tf.boolean_mask(ids, known)
+    rows = tf.boolean_mask(tokens.value_rowids(), known)
+    token_counts = tf.math.bincount(tf.cast(ids, tf.int32), minlength=size,
+                                    maxlength=size, dtype=tf.int64)
+    doc_ids, _ = tf.unique(rows * size + ids)
+    doc_counts = tf.math.bincount(tf.cast(doc_ids % size, tf.int32),
+                                  minlength=size, maxlength=size,
+                                  dtype=tf.int64)
+    return token_counts, doc_counts, tokens.nrows()
+
+  zeros = tf.zeros([size], dtype=tf.int64)
+  token_counts, doc_counts, num_docs = tokens_ds.map(
+      candidate_counts, num_parallel_calls=tf.data.AUTOTUNE,
+      deterministic=False).reduce(
+          (zeros, zeros, tf.constant(0, dtype=tf.int64)),
+          lambda total, batch: tuple(a + b for a, b in zip(total, batch)))
+
+  token_counts = token_counts.numpy()
+  order = np.lexsort((candidates, token_counts))[::-1][:num_tokens]
+  if (num_tokens is not None and len(order) == num_tokens
+      and token_counts[order[-1]] <= subtracted):
+    warnings.warn('parallel_adapt: the last vocabulary token was counted {} '
+                  'times, a token dropped from the sketch could have up to {}, '
+                  'the vocabulary may differ from adapt. increase '
+                  'sketch_factor.'.format(token_counts[order[-1]], subtracted))
+  vocabulary = [token.decode('utf-8') for token in candidates[order]]
+  if config['output_mode'] == 'tf_idf':
+    # same inverse document frequency as adapt
+    idf_weights = np.log(1 + num_docs.numpy() / (1 + doc_counts.numpy()[order]))
+    layer.set_vocabulary(vocabulary, idf_weights=idf_weights)
+  else:
+    layer.set_vocabulary(vocabulary)
+  return vocabulary
+
+parallel_text_vectorization = tf.keras.layers.TextVectorization(output_mode='tf_idf', max_tokens=1200, output_sequence_length=None)
+
+start = time.time()
+parallel_adapt(parallel_text_vectorization, train_data.map(lambda x: x['text']))
+print("parallel_adapt: {:.1f}s".format(time.time() - start))
+assert parallel_text_vectorization.get_vocabulary() == text_vectorization.get_vocabulary()
+
 def vectorize(features):
   return text_vectorization(features['text']), features['label']
 
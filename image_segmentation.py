@@ -30,7 +30,10 @@ import matplotlib.pyplot as plt
 
 dataset, info = tfds.load('oxford_iiit_pet:3.*.*', with_info=True)
 
-"""The colors will be normalizes to [0-1]. The masks labels get each subtracted one, resulting in {0,1,2}"""
+"""The colors will be normalizes to [0-1]. The masks labels get each subtracted one, resulting in {0,1,2}
+
+load_image only resizes and keeps both image and mask as uint8, so the cache holds 4x less memory than float32. the mask is resized with nearest neighbour, bilinear would interpolate between the class labels and produce fractional labels at the borders. normalize is applied after the cache, on whole batches.
+"""
 
 def normalize(input_image, input_mask):
   input_image = tf.cast(input_image, tf.float32) / 255.0
@@ -39,9 +42,10 @@ def normalize(input_image, input_mask):
 
 def load_image(datapoint):
   input_image = tf.image.resize(datapoint['image'], (128, 128))
-  input_mask = tf.image.resize(datapoint['segmentation_mask'], (128, 128))
-
-  input_image, input_mask = normalize(input_image, input_mask)
+  input_image = tf.saturate_cast(tf.round(input_image), tf.uint8)
+  input_mask = tf.image.resize(
+      datapoint['segmentation_mask'], (128, 128),
+      method=tf.image.ResizeMethod.NEAREST_NEIGHBOR)
 
   return input_image, input_mask
 
@@ -77,10 +81,20 @@ train_batches = (
     .shuffle(BUFFER_SIZE)
     .batch(BATCH_SIZE)
     .repeat()
+    .map(normalize, num_parallel_calls=tf.data.AUTOTUNE)
     .map(Augment())
     .prefetch(buffer_size=tf.data.AUTOTUNE))
 
-test_batches = test_images.batch(BATCH_SIZE)
+test_batches = test_images.batch(BATCH_SIZE).map(normalize)
+
+"""size of one cached example compared with caching float32:"""
+
+cached_bytes = sum(spec.shape.num_elements() * spec.dtype.size
+                   for spec in train_images.element_spec)
+float_bytes = sum(spec.shape.num_elements() * 4
+                  for spec in train_images.element_spec)
+print("cache: {:.1f}MB (float32: {:.1f}MB)".format(
+    TRAIN_LENGTH * cached_bytes / 2**20, TRAIN_LENGTH * float_bytes / 2**20))
 
 """visualization"""
 
@@ -184,11 +198,132 @@ def show_predictions(dataset=None, num=1):
 
 show_predictions()
 
-class DisplayCallback(tf.keras.callbacks.Callback):
+"""visual callbacks should not stall training: model.predict and the matplotlib rendering on the training thread cost time every epoch.
+
+BackgroundCallback splits a callback in two parts: `snapshot` runs on the training thread and only takes a cheap copy (a prediction for one image, the weights as numpy arrays). `render` runs on a background thread and does the plotting and file writing. the queue between them is bounded, if the worker can not keep up the new snapshot is dropped instead of blocking training.
+
+the figures are rendered with matplotlib.figure.Figure directly, pyplot is not thread safe. DisplayCallback writes one png per epoch to `predictions/`, with `inline=True` the training thread shows the latest of them below the cell.
+"""
+
+import os
+import queue
+import threading
+import traceback
+
+import numpy as np
+from IPython.display import Image
+from IPython.display import display as display_inline
+from matplotlib.figure import Figure
+
+class BackgroundCallback(tf.keras.callbacks.Callback):
+  def __init__(self, max_queue_size=2, end_timeout=60.):
+    super().__init__()
+    self.max_queue_size = max_queue_size
+    self.end_timeout = end_timeout
+    self.dropped = 0
+    self.failed = 0
+
+  def snapshot(self, epoch, logs):
+    raise NotImplementedError
+
+  def render(self, snapshot):
+    raise NotImplementedError
+
+  def _work(self):
+    while True:
+      snapshot = self._queue.get()
+      if snapshot is None:
+        break
+      try:
+        self.render(snapshot)
+      except Exception:
+        # keep the worker alive, a failed render must not block fit()
+        self.failed += 1
+        print('{}: render failed\n{}'.format(type(self).__name__,
+                                             traceback.format_exc()))
+
+  def on_train_begin(self, logs=None):
+    self._queue = queue.Queue(maxsize=self.max_queue_size)
+    self._worker = threading.Thread(target=self._work, daemon=True)
+    self._worker.start()
+
   def on_epoch_end(self, epoch, logs=None):
-    clear_output(wait=True)
-    show_predictions()
-    print ('\nSample Prediction after epoch {}\n'.format(epoch+1))
+    try:
+      self._queue.put_nowait(self.snapshot(epoch, dict(logs or {})))
+    except queue.Full:
+      self.dropped += 1
+
+  def on_train_end(self, logs=None):
+    try:
+      self._queue.put(None, timeout=self.end_timeout)
+    except queue.Full:
+      pass
+    self._worker.join(timeout=self.end_timeout)
+    if self._worker.is_alive():
+      print('{}: worker still busy after {}s, not waiting for it'.format(
+          type(self).__name__, self.end_timeout))
+    if self.dropped or self.failed:
+      print('{}: dropped {} snapshots, {} renders failed'.format(
+          type(self).__name__, self.dropped, self.failed))
+
+class DisplayCallback(BackgroundCallback):
+  def __init__(self, image=None, mask=None, out_dir='predictions', inline=True,
+               **kwargs):
+    super().__init__(**kwargs)
+    self.image = sample_image if image is None else image
+    self.mask = sample_mask if mask is None else mask
+    self.out_dir = out_dir
+    self.inline = inline
+    self._latest = None
+    os.makedirs(out_dir, exist_ok=True)
+
+  def on_train_begin(self, logs=None):
+    super().on_train_begin(logs)
+    # one compiled forward pass on a single image, much cheaper than predict
+    self._forward = tf.function(lambda x: self.model(x, training=False))
+
+  def snapshot(self, epoch, logs):
+    pred_mask = self._forward(self.image[tf.newaxis, ...])
+    return epoch, create_mask(pred_mask).numpy()
+
+  def on_epoch_end(self, epoch, logs=None):
+    super().on_epoch_end(epoch, logs)
+    # inline display only shows the latest png the worker has written,
+    # that is cheap enough for the training thread
+    if self.inline and self._latest is not None:
+      clear_output(wait=True)
+      display_inline(Image(filename=self._latest))
+
+  def render(self, snapshot):
+    epoch, pred_mask = snapshot
+    fig = Figure(figsize=(15, 5))
+    title = ['Input Image', 'True Mask', 'Predicted Mask']
+    for i, item in enumerate([self.image, self.mask, pred_mask]):
+      ax = fig.add_subplot(1, 3, i + 1)
+      ax.set_title(title[i])
+      ax.imshow(tf.keras.utils.array_to_img(item))
+      ax.axis('off')
+    path = os.path.join(self.out_dir, 'epoch_{:03d}.png'.format(epoch + 1))
+    fig.savefig(path)
+    self._latest = path
+
+class WeightHistogramCallback(BackgroundCallback):
+  """diagnostic example: histogram of the trainable weights of each epoch"""
+  def __init__(self, out_dir='weight_histograms', **kwargs):
+    super().__init__(**kwargs)
+    self.out_dir = out_dir
+    os.makedirs(out_dir, exist_ok=True)
+
+  def snapshot(self, epoch, logs):
+    return epoch, [(w.name, w.numpy()) for w in self.model.trainable_weights]
+
+  def render(self, snapshot):
+    epoch, weights = snapshot
+    fig = Figure(figsize=(8, 5))
+    ax = fig.add_subplot(1, 1, 1)
+    ax.hist(np.concatenate([w.ravel() for _, w in weights]), bins=100, log=True)
+    ax.set_title('Trainable weights after epoch {}'.format(epoch + 1))
+    fig.savefig(os.path.join(self.out_dir, 'epoch_{:03d}.png'.format(epoch + 1)))
 
 EPOCHS = 20
 VAL_SUBSPLITS = 5
@@ -198,7 +333,8 @@ model_history = model.fit(train_batches, epochs=EPOCHS,
                           steps_per_epoch=STEPS_PER_EPOCH,
                           validation_steps=VALIDATION_STEPS,
                           validation_data=test_batches,
-                          callbacks=[DisplayCallback()])
+                          callbacks=[DisplayCallback(),
+                                     WeightHistogramCallback()])
 
 loss = model_history.history['loss']
 val_loss = model_history.history['val_loss']
@@ -215,4 +351,257 @@ plt.show()
 
 """#predict"""
 
-show_predictions(test_batches, 3)
\ No newline at end of file
+show_predictions(test_batches, 3)
+
+"""#Training the decoder on cached encoder features
+down_stack is frozen, still every step of every epoch runs the full MobileNetV2 forward pass to compute the same five skip activations again.
+
+instead the encoder is run once over the un-augmented training images and the skip features are written to memory-mapped .npy files (float16, to halve the disk space: about 1.2MB per image). only the decoder is trained on these features. the random horizontal flip is applied to all features and the mask together. note: MobileNetV2 is not exactly flip-equivariant (strided convolutions pad asymmetrically), so flipped features are a close approximation of the features of a flipped image.
+
+after training, encoder and decoder are combined into a full model for prediction.
+"""
+
+import hashlib
+import time
+
+FEATURE_CACHE_DIR = 'segmentation_features'
+
+def model_fingerprint(model):
+  """model name and a hash of its weights, changes when the model is trained"""
+  digest = hashlib.sha1()
+  for weight in model.get_weights():
+    digest.update(np.ascontiguousarray(weight).tobytes())
+  return '{}-{}'.format(model.name, digest.hexdigest()[:16])
+
+def cache_encoder_features(images, cache_dir=FEATURE_CACHE_DIR):
+  # features of other encoder weights (e.g. after unfreezing down_stack)
+  # go to another subdirectory instead of being served from the old files
+  cache_dir = os.path.join(cache_dir, model_fingerprint(down_stack))
+  shapes = [tuple(output.shape[1:]) for output in down_stack.outputs]
+  num_examples = int(images.cardinality())
+  paths = [os.path.join(cache_dir, 'skip_{}.npy'.format(i))
+           for i in range(len(shapes))]
+  mask_path = os.path.join(cache_dir, 'masks.npy')
+  done_path = os.path.join(cache_dir, 'done')
+
+  if not os.path.exists(done_path):
+    os.makedirs(cache_dir, exist_ok=True)
+    features = [np.lib.format.open_memmap(path, mode='w+', dtype=np.float16,
+                                          shape=(num_examples,) + shape)
+                for path, shape in zip(paths, shapes)]
+    masks = np.lib.format.open_memmap(mask_path, mode='w+', dtype=np.uint8,
+                                      shape=(num_examples, 128, 128, 1))
+    offset = 0
+    for image_batch, mask_batch in images.batch(BATCH_SIZE).prefetch(tf.data.AUTOTUNE):
+      image_batch = tf.cast(image_batch, tf.float32) / 255.0
+      skips = down_stack(image_batch, training=False)
+      end = offset + len(image_batch)
+      for feature, skip in zip(features, skips):
+        feature[offset:end] = skip.numpy()
+      masks[offset:end] = mask_batch.numpy() - 1
+      offset = end
+    for array in features + [masks]:
+      array.flush()
+    del features, masks
+    open(done_path, 'w').close()
+
+  return ([np.load(path, mmap_mode='r') for path in paths],
+          np.load(mask_path, mmap_mode='r'))
+
+def feature_batches(features, masks, batch_size=BATCH_SIZE, seed=42):
+  rng = np.random.default_rng(seed)
+  num_examples = len(masks)
+
+  def generate():
+    # sorted indices within a batch keep the memmap reads mostly sequential
+    indices = rng.permutation(num_examples)
+    for start in range(0, num_examples, batch_size):
+      batch = np.sort(indices[start:start + batch_size])
+      yield tuple(feature[batch] for feature in features), masks[batch]
+
+  def flip(skips, mask):
+    flip_mask = tf.random.uniform([tf.shape(mask)[0], 1, 1, 1]) < 0.5
+    skips = tuple(tf.where(flip_mask, tf.reverse(skip, axis=[2]), skip)
+                  for skip in skips)
+    mask = tf.where(flip_mask, tf.reverse(mask, axis=[2]), mask)
+    return tuple(tf.cast(skip, tf.float32) for skip in skips), mask
+
+  signature = (
+      tuple(tf.TensorSpec((None,) + feature.shape[1:], tf.float16)
+            for feature in features),
+      tf.TensorSpec((None,) + masks.shape[1:], tf.uint8))
+  return (tf.data.Dataset.from_generator(generate, output_signature=signature)
+          .map(flip, num_parallel_calls=tf.data.AUTOTUNE)
+          .prefetch(tf.data.AUTOTUNE))
+
+"""decoder with the skip features as inputs, same structure as unet_model:"""
+
+def decoder_model(output_channels:int):
+  skip_inputs = [tf.keras.layers.Input(shape=output.shape[1:])
+                 for output in down_stack.outputs]
+  decoder_up_stack = [
+      pix2pix.upsample(512, 3),  # 4x4 -> 8x8
+      pix2pix.upsample(256, 3),  # 8x8 -> 16x16
+      pix2pix.upsample(128, 3),  # 16x16 -> 32x32
+      pix2pix.upsample(64, 3),   # 32x32 -> 64x64
+  ]
+
+  x = skip_inputs[-1]
+  for up, skip in zip(decoder_up_stack, reversed(skip_inputs[:-1])):
+    x = up(x)
+    x = tf.keras.layers.Concatenate()([x, skip])
+
+  x = tf.keras.layers.Conv2DTranspose(
+      filters=output_channels, kernel_size=3, strides=2,
+      padding='same')(x)  #64x64 -> 128x128
+
+  return tf.keras.Model(inputs=skip_inputs, outputs=x)
+
+start = time.time()
+cached_features, cached_masks = cache_encoder_features(train_images)
+print("feature cache: {:.1f}s".format(time.time() - start))
+
+decoder = decoder_model(output_channels=OUTPUT_CLASSES)
+decoder.compile(optimizer='adam',
+                loss=tf.keras.losses.SparseCategoricalCrossentropy(from_logits=True),
+                metrics=['accuracy'])
+
+class EpochTimer(tf.keras.callbacks.Callback):
+  def on_train_begin(self, logs=None):
+    self.seconds = []
+
+  def on_epoch_begin(self, epoch, logs=None):
+    self._start = time.time()
+
+  def on_epoch_end(self, epoch, logs=None):
+    self.seconds.append(time.time() - self._start)
+
+decoder_timer = EpochTimer()
+decoder_history = decoder.fit(feature_batches(cached_features, cached_masks),
+                              epochs=EPOCHS, callbacks=[decoder_timer])
+
+"""for comparison, two epochs of the full U-Net with the same batch size. it is trained on a clone, so `model` from above is not changed. the first epoch of both includes the tracing and is left out."""
+
+full_model = tf.keras.models.clone_model(model)
+full_model.set_weights(model.get_weights())
+for layer in full_model.layers:
+  if isinstance(layer, tf.keras.Model):  # the cloned down_stack
+    layer.trainable = False
+full_model.compile(optimizer='adam',
+                   loss=tf.keras.losses.SparseCategoricalCrossentropy(from_logits=True),
+                   metrics=['accuracy'])
+full_timer = EpochTimer()
+full_model.fit(train_batches, epochs=2, steps_per_epoch=STEPS_PER_EPOCH,
+               callbacks=[full_timer], verbose=0)
+
+print("full U-Net:      {:.1f}s/epoch".format(full_timer.seconds[-1]))
+print("cached decoder:  {:.1f}s/epoch".format(np.mean(decoder_timer.seconds[1:])))
+
+"""combine the frozen encoder and the trained decoder for prediction:"""
+
+inputs = tf.keras.layers.Input(shape=[128, 128, 3])
+cached_model = tf.keras.Model(inputs, decoder(down_stack(inputs)))
+cached_model.compile(optimizer='adam',
+                     loss=tf.keras.losses.SparseCategoricalCrossentropy(from_logits=True),
+                     metrics=['accuracy'])
+cached_model.evaluate(test_batches)
+
+for image, mask in test_batches.take(3):
+  display([image[0], mask[0], create_mask(cached_model.predict(image))])
+
+"""#Tiled inference on large images
+unet_model only accepts 128x128 inputs. predict_tiled splits an image of any size into overlapping 128x128 tiles, runs them through the model in large batches and blends the logits back together. every tile's logits are weighted with a window that ramps up over the overlap, so the seams between tiles get a smooth average instead of hard edges.
+
+the image is processed one row of tiles at a time and only a buffer of one tile height is kept: as soon as no further tile touches a row of the output it is written. with a np.memmap as `image` and as `output`, images much larger than the memory can be segmented.
+"""
+
+def tile_positions(size, tile, stride):
+  positions = list(range(0, max(size - tile, 0) + 1, stride))
+  if positions[-1] + tile < size:
+    positions.append(size - tile)
+  return positions
+
+def tile_window(tile, overlap):
+  distance = np.minimum(np.arange(tile), tile - 1 - np.arange(tile))
+  ramp = np.clip((distance + 1) / (overlap + 1), 0., 1.)
+  return np.outer(ramp, ramp)[..., np.newaxis].astype(np.float32)
+
+def predict_tiled(model, image, output=None, tile=128, overlap=32,
+                  batch_size=64, num_classes=OUTPUT_CLASSES):
+  height, width = image.shape[:2]
+  if height < tile or width < tile:
+    # small images: pad once to a single tile
+    image = np.pad(image, [(0, max(tile - height, 0)),
+                           (0, max(tile - width, 0)), (0, 0)], mode='reflect')
+  padded_height, padded_width = image.shape[:2]
+  if output is None:
+    output = np.empty((height, width, num_classes), np.float32)
+
+  stride = tile - overlap
+  ys = tile_positions(padded_height, tile, stride)
+  xs = tile_positions(padded_width, tile, stride)
+  window = tile_window(tile, overlap)
+  forward = tf.function(lambda x: model(x, training=False))
+
+  # logits and weights for the rows [top, top + tile)
+  logits_sum = np.zeros((tile, padded_width, num_classes), np.float32)
+  weight_sum = np.zeros((tile, padded_width, 1), np.float32)
+  top = 0
+
+  def flush(rows):
+    # rows [top, top + rows) are complete
+    end = min(top + rows, height)
+    if end > top:
+      output[top:end] = (logits_sum[:end - top, :width] /
+                         weight_sum[:end - top, :width])
+    logits_sum[:tile - rows] = logits_sum[rows:]
+    logits_sum[tile - rows:] = 0.
+    weight_sum[:tile - rows] = weight_sum[rows:]
+    weight_sum[tile - rows:] = 0.
+
+  for y in ys:
+    if y > top:
+      flush(y - top)
+      top = y
+    row = np.asarray(image[y:y + tile])
+    tiles = np.stack([row[:, x:x + tile] for x in xs])
+    for start in range(0, len(xs), batch_size):
+      batch = tf.cast(tiles[start:start + batch_size], tf.float32) / 255.0
+      logits = forward(batch).numpy()
+      for x, tile_logits in zip(xs[start:start + batch_size], logits):
+        logits_sum[:, x:x + tile] += tile_logits * window
+        weight_sum[:, x:x + tile] += window
+  flush(tile)
+  return output
+
+"""a large test image, made of 8x12 test images (1024x1536 pixels):"""
+
+test_examples = dataset['test'].map(load_image).take(96).batch(96)
+large_image, large_mask = next(iter(test_examples))
+large_image = tf.reshape(tf.transpose(tf.reshape(large_image, [8, 12, 128, 128, 3]),
+                                      [0, 2, 1, 3, 4]), [1024, 1536, 3]).numpy()
+large_mask = tf.reshape(tf.transpose(tf.reshape(large_mask, [8, 12, 128, 128, 1]),
+                                     [0, 2, 1, 3, 4]), [1024, 1536, 1]).numpy() - 1
+
+start = time.time()
+large_logits = predict_tiled(model, large_image)
+seconds = time.time() - start
+print("{:.2f} megapixels/sec".format(
+    large_image.shape[0] * large_image.shape[1] / 1e6 / seconds))
+
+display([large_image, large_mask, np.argmax(large_logits, axis=-1)[..., np.newaxis]])
+
+"""streaming: input and output as memory-mapped files on disk, only a band of one tile height is held in memory"""
+
+large_input = np.lib.format.open_memmap('large_image.npy', mode='w+', dtype=np.uint8,
+                                        shape=(4096, 6144, 3))
+large_input[:] = np.tile(large_image, (4, 4, 1))
+large_output = np.lib.format.open_memmap('large_logits.npy', mode='w+',
+                                         dtype=np.float32,
+                                         shape=(4096, 6144, OUTPUT_CLASSES))
+
+start = time.time()
+predict_tiled(model, large_input, output=large_output, batch_size=256)
+large_output.flush()
+seconds = time.time() - start
+print("{:.2f} megapixels/sec".format(4096 * 6144 / 1e6 / seconds))
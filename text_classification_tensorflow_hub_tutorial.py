@@ -78,4 +78,198 @@ history = model.fit(train_data.shuffle(10000).batch(512),
 results = model.evaluate(test_data.batch(512), verbose=2)
 
 for name, value in zip(model.metrics_names, results):
-  print("%s: %.3f" % (name, value))
\ No newline at end of file
+  print("%s: %.3f" % (name, value))
+
+"""# Offline model registry
+hub.KerasLayer with the tfhub.dev url resolves (and downloads) nnlm-en-dim50 at every process start, which does not work without internet access.
+
+LocalHubRegistry resolves the same handle ('nnlm-en-dim50' or the full url) to a pre-staged SavedModel directory below a local root (the url path without the host: `<root>/google/nnlm-en-dim50/2`), loads it only on first use and keeps the loaded model for further frozen layers of the same process (a trainable layer loads its own copy, its weights are not shared). nothing is downloaded; what a process start still costs is loading the SavedModel from disk. the root is taken from the HUB_REGISTRY_DIR environment variable.
+"""
+
+import shutil
+import tempfile
+import time
+
+HUB_ALIASES = {
+    'mobilenet_v2': 'https://tfhub.dev/google/tf2-preview/mobilenet_v2/feature_vector/4',
+    'mobilenet_v2_classification': 'https://tfhub.dev/google/tf2-preview/mobilenet_v2/classification/4',
+    'inception_v3': 'https://tfhub.dev/google/tf2-preview/inception_v3/feature_vector/4',
+    'inception_v3_classification': 'https://tfhub.dev/google/imagenet/inception_v3/classification/5',
+    'nnlm-en-dim50': 'https://tfhub.dev/google/nnlm-en-dim50/2',
+}
+
+class LocalHubRegistry(object):
+  def __init__(self, root, aliases=HUB_ALIASES):
+    self.root = root
+    self.aliases = dict(aliases)
+    self._loaded = {}
+
+  def resolve(self, handle):
+    """alias, tfhub.dev url or local path -> local SavedModel directory"""
+    handle = self.aliases.get(handle, handle)
+    if os.path.isdir(handle):
+      return handle
+    path = handle.split('://', 1)[-1].split('/', 1)[-1]  # drop scheme and host
+    local_dir = os.path.join(self.root, *path.strip('/').split('/'))
+    if not os.path.exists(os.path.join(local_dir, 'saved_model.pb')):
+      raise FileNotFoundError(
+          '{} is not staged in the local registry, expected a SavedModel '
+          'in {}'.format(handle, local_dir))
+    return local_dir
+
+  def stage(self, handle, saved_model_dir):
+    """copies a SavedModel into the registry under the path of `handle`"""
+    handle = self.aliases.get(handle, handle)
+    path = handle.split('://', 1)[-1].split('/', 1)[-1]
+    local_dir = os.path.join(self.root, *path.strip('/').split('/'))
+    shutil.copytree(saved_model_dir, local_dir, dirs_exist_ok=True)
+    return local_dir
+
+  def load(self, handle):
+    """loads a SavedModel on first use, afterwards returns the same object"""
+    local_dir = self.resolve(handle)
+    if local_dir not in self._loaded:
+      self._loaded[local_dir] = tf.saved_model.load(local_dir)
+    return self._loaded[local_dir]
+
+  def keras_layer(self, handle, trainable=False, **kwargs):
+    """hub.KerasLayer for `handle`. frozen layers share the cached model, a
+    trainable layer gets its own freshly loaded copy so that training it does
+    not change the weights of any other layer, like with hub.KerasLayer(url)"""
+    if trainable:
+      obj = tf.saved_model.load(self.resolve(handle))
+    else:
+      obj = self.load(handle)
+    return hub.KerasLayer(obj, trainable=trainable, **kwargs)
+
+
+hub_registry = LocalHubRegistry(os.environ.get('HUB_REGISTRY_DIR', '/opt/hub_models'))
+
+"""test with a dummy text embedding SavedModel: strings -> [batch, 50], staged under the nnlm-en-dim50 handle in a temporary registry"""
+
+class DummyTextEmbedding(tf.Module):
+  def __init__(self):
+    super().__init__()
+    self.embeddings = tf.Variable(tf.random.normal([1000, 50]))
+
+  @tf.function(input_signature=[tf.TensorSpec([None], tf.string)])
+  def __call__(self, sentences):
+    tokens = tf.strings.to_hash_bucket_fast(tf.strings.split(sentences), 1000)
+    return tf.reduce_mean(tf.gather(self.embeddings, tokens), axis=1)
+
+test_registry = LocalHubRegistry(tempfile.mkdtemp())
+dummy_dir = tempfile.mkdtemp()
+tf.saved_model.save(DummyTextEmbedding(), dummy_dir)
+test_registry.stage('nnlm-en-dim50', dummy_dir)
+
+start = time.time()
+dummy_layer = test_registry.keras_layer('nnlm-en-dim50', input_shape=[],
+                                        dtype=tf.string, trainable=True)
+print("first layer, loads the SavedModel: {:.0f}ms".format(1000 * (time.time() - start)))
+assert dummy_layer(train_examples_batch[:3]).shape == (3, 50)
+
+"""with the real model staged, the hub layer from above is built offline with:"""
+
+# hub_layer = hub_registry.keras_layer('nnlm-en-dim50', input_shape=[],
+#                                      dtype=tf.string, trainable=True)
+
+"""# Embedding cache for a frozen hub layer
+with trainable=False the hub layer maps every review to the same 50-d vector in every epoch, only the two Dense layers learn. recomputing the embeddings each epoch is wasted work.
+
+fit_with_embedding_cache embeds every split once (in parallel tf.data batches), writes the vectors and labels to memory-mapped .npy files and trains only the Dense head on them. the files are reused by later runs. if the hub layer is trainable the embeddings change during training, so it falls back to training the full model on the text as above.
+
+the files are kept per hub model: the subdirectory is named after a hash of the handle and the weights of the hub layer, so another handle (or changed weights) never reads the embeddings of the previous one.
+
+the returned model always takes the raw strings: hub layer + trained head.
+"""
+
+import hashlib
+
+EMBEDDING_CACHE_DIR = 'nnlm_embeddings'
+
+def hub_layer_fingerprint(hub_layer):
+  try:
+    handle = hub_layer.get_config()['handle']
+  except NotImplementedError:
+    # built from a loaded object instead of a handle string
+    handle = hub_layer.name
+  digest = hashlib.sha1(str(handle).encode('utf-8'))
+  for weight in hub_layer.get_weights():
+    digest.update(np.ascontiguousarray(weight).tobytes())
+  return digest.hexdigest()[:16]
+
+def cached_embeddings(hub_layer, data, name, cache_dir=EMBEDDING_CACHE_DIR,
+                      batch_size=1024):
+  cache_dir = os.path.join(cache_dir, hub_layer_fingerprint(hub_layer))
+  features_path = os.path.join(cache_dir, name + '_features.npy')
+  labels_path = os.path.join(cache_dir, name + '_labels.npy')
+  if not os.path.exists(labels_path):
+    os.makedirs(cache_dir, exist_ok=True)
+    num_examples = int(data.cardinality())
+    embedding_dim = hub_layer(tf.constant([''])).shape[-1]
+    features = np.lib.format.open_memmap(
+        features_path + '.tmp', mode='w+', dtype=np.float32,
+        shape=(num_examples, embedding_dim))
+    labels = np.empty(num_examples, dtype=np.int64)
+    embedded = (data.batch(batch_size)
+                .map(lambda x, y: (hub_layer(x), y),
+                     num_parallel_calls=tf.data.AUTOTUNE)
+                .prefetch(tf.data.AUTOTUNE))
+    offset = 0
+    for batch_features, batch_labels in embedded:
+      end = offset + len(batch_labels)
+      features[offset:end] = batch_features.numpy()
+      labels[offset:end] = batch_labels.numpy()
+      offset = end
+    features.flush()
+    del features
+    os.replace(features_path + '.tmp', features_path)
+    # the labels file marks the cache as complete
+    np.save(labels_path, labels)
+  return np.load(features_path, mmap_mode='r'), np.load(labels_path)
+
+def fit_with_embedding_cache(hub_layer, epochs=10):
+  head = tf.keras.Sequential([
+    tf.keras.layers.Dense(16, activation='relu'),
+    tf.keras.layers.Dense(1)
+  ])
+  text_model = tf.keras.Sequential([hub_layer, head])
+
+  if hub_layer.trainable:
+    text_model.compile(optimizer='adam',
+                       loss=tf.keras.losses.BinaryCrossentropy(from_logits=True),
+                       metrics=['accuracy'])
+    text_model.fit(train_data.shuffle(10000).batch(512),
+                   epochs=epochs,
+                   validation_data=validation_data.batch(512),
+                   verbose=1)
+    return text_model
+
+  train_features, train_labels = cached_embeddings(hub_layer, train_data, 'train')
+  val_features, val_labels = cached_embeddings(hub_layer, validation_data, 'validation')
+
+  head.compile(optimizer='adam',
+               loss=tf.keras.losses.BinaryCrossentropy(from_logits=True),
+               metrics=['accuracy'])
+  head.fit(train_features, train_labels,
+           batch_size=512,
+           shuffle=True,
+           epochs=epochs,
+           validation_data=(val_features, val_labels),
+           verbose=1)
+  text_model.compile(optimizer='adam',
+                     loss=tf.keras.losses.BinaryCrossentropy(from_logits=True),
+                     metrics=['accuracy'])
+  return text_model
+
+frozen_hub_layer = hub.KerasLayer(embedding, input_shape=[],
+                                  dtype=tf.string, trainable=False)
+
+start = time.time()
+frozen_model = fit_with_embedding_cache(frozen_hub_layer)
+print("frozen hub layer, cached embeddings: {:.1f}s".format(time.time() - start))
+
+results = frozen_model.evaluate(test_data.batch(512), verbose=2)
+
+for name, value in zip(frozen_model.metrics_names, results):
+  print("%s: %.3f" % (name, value))
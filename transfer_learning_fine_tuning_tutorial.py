@@ -217,6 +217,137 @@ plt.title('Training and Validation Loss')
 plt.xlabel('epoch')
 plt.show()
 
+"""##Cached bottleneck features
+while base_model is frozen, its output for an image never changes, but the model above runs the whole MobileNetV2 forward pass on every batch of every epoch just to train the Dense layer on top.
+
+BottleneckFeatureStore computes the features once per image and keeps them in a memory-mapped file on disk, keyed by a hash of the image content. the same image is never computed twice, also not across runs or after the dataset was reshuffled. the extractor contains preprocess_input, the frozen base model and the GlobalAveragePooling2D (which has no weights), so one 1280 vector per image is stored. the store lives in a subdirectory named after the extractor and a hash of its weights, features of a fine-tuned base model never mix with the ones of the pretrained weights.
+
+optionally `num_variants` augmented versions of each image are computed once and cached as well, the head then trains on the original and all variants.
+"""
+
+import hashlib
+import json
+import time
+
+def model_fingerprint(model):
+  """model name and a hash of its weights, changes when the model is trained"""
+  digest = hashlib.sha1()
+  for weight in model.get_weights():
+    digest.update(np.ascontiguousarray(weight).tobytes())
+  return '{}-{}'.format(model.name, digest.hexdigest()[:16])
+
+class BottleneckFeatureStore(object):
+  def __init__(self, directory, extractor, feature_dim, capacity=4096):
+    # one store per extractor state: after fine-tuning the base model the
+    # stored features are outdated, a new subdirectory is used
+    directory = os.path.join(directory, model_fingerprint(extractor))
+    self.directory = directory
+    self.extractor = extractor
+    self.feature_dim = feature_dim
+    os.makedirs(directory, exist_ok=True)
+    self._features_path = os.path.join(directory, 'features.npy')
+    self._index_path = os.path.join(directory, 'index.json')
+
+    if os.path.exists(self._index_path):
+      with open(self._index_path) as f:
+        self.index = json.load(f)
+      self.features = np.load(self._features_path, mmap_mode='r+')
+    else:
+      self.index = {}
+      self.features = np.lib.format.open_memmap(
+          self._features_path, mode='w+', dtype=np.float32,
+          shape=(capacity, feature_dim))
+
+  def _grow(self, min_capacity):
+    capacity = max(min_capacity, 2 * len(self.features))
+    old_features = np.array(self.features[:len(self.index)])
+    del self.features
+    self.features = np.lib.format.open_memmap(
+        self._features_path, mode='w+', dtype=np.float32,
+        shape=(capacity, self.feature_dim))
+    self.features[:len(old_features)] = old_features
+
+  def rows(self, images, variant=0):
+    """row of every image in `features`, computes and stores the missing ones"""
+    images = np.asarray(images)
+    keys = ['{}:{}'.format(hashlib.sha1(image.tobytes()).hexdigest(), variant)
+            for image in images]
+    missing = [i for i, key in enumerate(keys) if key not in self.index]
+    if missing:
+      batch = images[missing]
+      if variant:
+        batch = data_augmentation(batch, training=True)
+      features = self.extractor(batch, training=False).numpy()
+      start = len(self.index)
+      if start + len(missing) > len(self.features):
+        self._grow(start + len(missing))
+      self.features[start:start + len(missing)] = features
+      for offset, i in enumerate(missing):
+        self.index[keys[i]] = start + offset
+    return np.array([self.index[key] for key in keys])
+
+  def flush(self):
+    self.features.flush()
+    with open(self._index_path, 'w') as f:
+      json.dump(self.index, f)
+
+  def dataset(self, images_ds, num_variants=0):
+    """(features, labels) of all images in images_ds, kept in memory"""
+    rows, labels = [], []
+    for images, batch_labels in images_ds:
+      for variant in range(num_variants + 1):
+        rows.append(self.rows(images, variant))
+        labels.append(batch_labels.numpy())
+    self.flush()
+    rows = np.concatenate(rows)
+    return np.array(self.features[rows]), np.concatenate(labels)
+
+inputs = tf.keras.Input(shape=(160, 160, 3))
+x = preprocess_input(inputs)
+x = base_model(x, training=False)
+outputs = global_average_layer(x)
+feature_extractor = tf.keras.Model(inputs, outputs)
+
+feature_store = BottleneckFeatureStore('bottleneck_features', feature_extractor,
+                                       feature_dim=1280)
+
+start = time.time()
+train_features, train_labels = feature_store.dataset(train_dataset, num_variants=2)
+val_features, val_labels = feature_store.dataset(validation_dataset)
+print("feature extraction: {:.1f}s".format(time.time() - start))
+
+"""the head trains on the cached vectors only. it is the same Dropout + Dense head as above, the pooling is part of the extractor"""
+
+feature_head = tf.keras.Sequential([
+  tf.keras.layers.Dropout(0.2),
+  tf.keras.layers.Dense(1)
+])
+feature_head.compile(optimizer=tf.keras.optimizers.Adam(learning_rate=base_learning_rate),
+                     loss=tf.keras.losses.BinaryCrossentropy(from_logits=True),
+                     metrics=['accuracy'])
+
+start = time.time()
+feature_head.fit(train_features, train_labels,
+                 epochs=initial_epochs,
+                 batch_size=BATCH_SIZE,
+                 shuffle=True,
+                 validation_data=(val_features, val_labels))
+print("head training: {:.1f}s".format(time.time() - start))
+
+"""the second run finds everything in the store, nothing is computed again:"""
+
+start = time.time()
+feature_store.dataset(train_dataset, num_variants=2)
+print("cached lookup: {:.1f}s".format(time.time() - start))
+
+"""put extractor and head together to evaluate on images:"""
+
+cached_head_model = tf.keras.Model(feature_extractor.input,
+                                   feature_head(feature_extractor.output))
+cached_head_model.compile(loss=tf.keras.losses.BinaryCrossentropy(from_logits=True),
+                          metrics=['accuracy'])
+cached_head_model.evaluate(test_dataset)
+
 """#Fine-Tuning
 previously, only the top layers were trained, the pre-trained weights were not updated.
 
@@ -293,6 +424,93 @@ plt.title('Training and Validation Loss')
 plt.xlabel('epoch')
 plt.show()
 
+"""##Partial fine-tuning above fine_tune_at
+the layers below fine_tune_at are frozen and, with training=False, deterministic. still every fine-tuning step runs them forward for every batch.
+
+split_at cuts the base model into a frozen prefix and a trainable suffix. the prefix returns every tensor that crosses the cut (MobileNetV2 has residual connections, so there can be more than one), the suffix is rebuilt from the same layer objects with these tensors as inputs, so it shares its weights with base_model and `model`.
+
+the prefix activations of every training image are computed once and cached, afterwards each epoch only runs the suffix and the head. the cached activations are from the un-augmented images, data_augmentation is not applied in this mode.
+"""
+
+def split_at(model, index):
+  suffix_layers = model.layers[index:]
+  produced = {id(layer.output) for layer in suffix_layers}
+  boundary = []
+  for layer in suffix_layers:
+    for tensor in tf.nest.flatten(layer.input):
+      if id(tensor) not in produced and all(tensor is not t for t in boundary):
+        boundary.append(tensor)
+
+  prefix = tf.keras.Model(model.input, boundary, name='prefix')
+
+  suffix_inputs = [tf.keras.Input(shape=tensor.shape[1:]) for tensor in boundary]
+  tensors = {id(old): new for old, new in zip(boundary, suffix_inputs)}
+  for layer in suffix_layers:
+    layer_inputs = tf.nest.map_structure(lambda t: tensors[id(t)], layer.input)
+    tensors[id(layer.output)] = layer(layer_inputs)
+  suffix = tf.keras.Model(suffix_inputs, tensors[id(model.output)], name='suffix')
+  return prefix, suffix
+
+class EpochTimer(tf.keras.callbacks.Callback):
+  def on_train_begin(self, logs=None):
+    self.seconds = []
+
+  def on_epoch_begin(self, epoch, logs=None):
+    self._start = time.time()
+
+  def on_epoch_end(self, epoch, logs=None):
+    self.seconds.append(time.time() - self._start)
+
+prefix, suffix = split_at(base_model, fine_tune_at)
+print("tensors crossing the cut:", [t.shape for t in prefix.outputs])
+
+def prefix_activations(images, labels):
+  activations = prefix(preprocess_input(images), training=False)
+  return tuple(tf.nest.flatten(activations)), labels
+
+cached_train = (train_dataset
+                .map(prefix_activations, num_parallel_calls=AUTOTUNE)
+                .cache('prefix_activations_train')
+                .shuffle(64)
+                .prefetch(AUTOTUNE))
+cached_validation = (validation_dataset
+                     .map(prefix_activations, num_parallel_calls=AUTOTUNE)
+                     .cache('prefix_activations_validation')
+                     .prefetch(AUTOTUNE))
+
+suffix_inputs = [tf.keras.Input(shape=t.shape[1:]) for t in prefix.outputs]
+x = suffix(suffix_inputs, training=False)
+x = global_average_layer(x)
+x = tf.keras.layers.Dropout(0.2)(x)
+outputs = prediction_layer(x)
+partial_model = tf.keras.Model(suffix_inputs, outputs)
+
+partial_model.compile(loss=tf.keras.losses.BinaryCrossentropy(from_logits=True),
+                      optimizer=tf.keras.optimizers.RMSprop(learning_rate=base_learning_rate/10),
+                      metrics=['accuracy'])
+print("trainable variables: {} (full model: {})".format(
+    len(partial_model.trainable_variables), len(model.trainable_variables)))
+
+"""time one epoch of the full model and of the partial model. the first partial epoch fills the cache. both runs update weights shared with `model`, they are restored afterwards so the evaluation below is of the fine-tuned model"""
+
+fine_tuned_weights = model.get_weights()
+
+full_timer = EpochTimer()
+model.fit(train_dataset, epochs=1, callbacks=[full_timer])
+
+partial_timer = EpochTimer()
+partial_model.fit(cached_train,
+                  epochs=fine_tune_epochs,
+                  validation_data=cached_validation,
+                  callbacks=[partial_timer])
+
+print("full fine-tuning:    {:.1f}s/epoch".format(full_timer.seconds[0]))
+print("partial, first epoch {:.1f}s (fills the cache)".format(partial_timer.seconds[0]))
+print("partial, cached:     {:.1f}s/epoch".format(
+    np.mean(partial_timer.seconds[1:])))
+
+model.set_weights(fine_tuned_weights)
+
 """##Evaluation and prediction"""
 
 loss, accuracy = model.evaluate(test_dataset)
@@ -250,4 +250,373 @@ for n in range(30):
   plt.imshow(image_batch[n])
   plt.title(reloaded_predicted_label_batch[n].title())
   plt.axis('off')
-_ = plt.suptitle("Model predictions")
\ No newline at end of file
+_ = plt.suptitle("Model predictions")
+
+"""#Offline model registry
+hub.KerasLayer with a tfhub.dev url resolves (and if needed downloads) the model at every process start, which fails on machines without internet access.
+
+LocalHubRegistry resolves the same handles (short aliases like 'mobilenet_v2' or the full tfhub.dev urls) to pre-staged SavedModel directories below a local root: the url path without the host, e.g. `<root>/google/tf2-preview/mobilenet_v2/feature_vector/4`. nothing is downloaded. the models are only loaded on first use and every loaded model is kept, so building further frozen layers from the same handle in the same process costs nothing. trainable layers load their own copy, so they never share weights with another layer. a new process still loads the SavedModel from disk, only the network access is gone. the root is taken from the HUB_REGISTRY_DIR environment variable.
+"""
+
+import os
+import shutil
+import tempfile
+
+HUB_ALIASES = {
+    'mobilenet_v2': 'https://tfhub.dev/google/tf2-preview/mobilenet_v2/feature_vector/4',
+    'mobilenet_v2_classification': 'https://tfhub.dev/google/tf2-preview/mobilenet_v2/classification/4',
+    'inception_v3': 'https://tfhub.dev/google/tf2-preview/inception_v3/feature_vector/4',
+    'inception_v3_classification': 'https://tfhub.dev/google/imagenet/inception_v3/classification/5',
+    'nnlm-en-dim50': 'https://tfhub.dev/google/nnlm-en-dim50/2',
+}
+
+class LocalHubRegistry(object):
+  def __init__(self, root, aliases=HUB_ALIASES):
+    self.root = root
+    self.aliases = dict(aliases)
+    self._loaded = {}
+
+  def resolve(self, handle):
+    """alias, tfhub.dev url or local path -> local SavedModel directory"""
+    handle = self.aliases.get(handle, handle)
+    if os.path.isdir(handle):
+      return handle
+    path = handle.split('://', 1)[-1].split('/', 1)[-1]  # drop scheme and host
+    local_dir = os.path.join(self.root, *path.strip('/').split('/'))
+    if not os.path.exists(os.path.join(local_dir, 'saved_model.pb')):
+      raise FileNotFoundError(
+          '{} is not staged in the local registry, expected a SavedModel '
+          'in {}'.format(handle, local_dir))
+    return local_dir
+
+  def stage(self, handle, saved_model_dir):
+    """copies a SavedModel into the registry under the path of `handle`"""
+    handle = self.aliases.get(handle, handle)
+    path = handle.split('://', 1)[-1].split('/', 1)[-1]
+    local_dir = os.path.join(self.root, *path.strip('/').split('/'))
+    shutil.copytree(saved_model_dir, local_dir, dirs_exist_ok=True)
+    return local_dir
+
+  def load(self, handle):
+    """loads a SavedModel on first use, afterwards returns the same object"""
+    local_dir = self.resolve(handle)
+    if local_dir not in self._loaded:
+      self._loaded[local_dir] = tf.saved_model.load(local_dir)
+    return self._loaded[local_dir]
+
+  def keras_layer(self, handle, trainable=False, **kwargs):
+    """hub.KerasLayer for `handle`. frozen layers share the cached model, a
+    trainable layer gets its own freshly loaded copy so that training it does
+    not change the weights of any other layer, like with hub.KerasLayer(url)"""
+    if trainable:
+      obj = tf.saved_model.load(self.resolve(handle))
+    else:
+      obj = self.load(handle)
+    return hub.KerasLayer(obj, trainable=trainable, **kwargs)
+
+
+hub_registry = LocalHubRegistry(os.environ.get('HUB_REGISTRY_DIR', '/opt/hub_models'))
+
+"""##test with a dummy SavedModel
+a small module with the same signature as the feature vector models: [batch, 224, 224, 3] images in [0, 1] -> [batch, 1280] features. it is staged under the mobilenet_v2 handle in a temporary registry.
+"""
+
+class DummyFeatureVector(tf.Module):
+  def __init__(self):
+    super().__init__()
+    self.kernel = tf.Variable(tf.random.normal([3, 1280]))
+
+  @tf.function(input_signature=[tf.TensorSpec([None, 224, 224, 3], tf.float32)])
+  def __call__(self, images):
+    return tf.matmul(tf.reduce_mean(images, axis=[1, 2]), self.kernel)
+
+test_registry = LocalHubRegistry(tempfile.mkdtemp())
+dummy_dir = tempfile.mkdtemp()
+tf.saved_model.save(DummyFeatureVector(), dummy_dir)
+test_registry.stage('mobilenet_v2', dummy_dir)
+
+start = time.time()
+dummy_layer = test_registry.keras_layer('mobilenet_v2', input_shape=(224, 224, 3),
+                                        trainable=False)
+print("first layer, loads the SavedModel: {:.0f}ms".format(1000 * (time.time() - start)))
+
+start = time.time()
+test_registry.keras_layer(mobilenet_v2, input_shape=(224, 224, 3), trainable=False)
+print("second layer from the same handle: {:.1f}ms".format(1000 * (time.time() - start)))
+
+assert dummy_layer(tf.zeros([2, 224, 224, 3])).shape == (2, 1280)
+
+try:
+  test_registry.load('inception_v3')
+except FileNotFoundError as e:
+  print(e)
+
+"""with the real models staged, the feature extractor from above is built offline with:"""
+
+# feature_extractor_layer = hub_registry.keras_layer(
+#     'mobilenet_v2', input_shape=(224, 224, 3), trainable=False)
+
+"""#Local inference server with dynamic batching
+the exported model is only used with predict on a whole batch above. a service gets single images instead, and running the model for every single image wastes most of the throughput.
+
+DynamicBatcher collects single-image requests from any number of threads and merges them into one batch, until either `max_batch_size` images are waiting or the oldest one has waited `max_delay` seconds. the server is a plain http.server: POST an encoded image (jpeg/png) to /predict, get back the class name and the logits as json. decoding and resizing run in the request threads, only the model call is batched.
+
+run_load_test is a built-in load generator: `concurrency` client threads send requests back to back, it reports throughput, p50/p99 latency and the mean batch size.
+"""
+
+import concurrent.futures
+import http.server
+import json
+import queue
+import threading
+import urllib.request
+
+class DynamicBatcher(object):
+  def __init__(self, predict_fn, max_batch_size=32, max_delay=0.005):
+    self.predict_fn = predict_fn
+    self.max_batch_size = max_batch_size
+    self.max_delay = max_delay
+    self.batch_sizes = []
+    self._requests = queue.Queue()
+    self._thread = threading.Thread(target=self._run, daemon=True)
+    self._thread.start()
+
+  def submit(self, image):
+    future = concurrent.futures.Future()
+    self._requests.put((image, future))
+    return future
+
+  def _run(self):
+    while True:
+      first = self._requests.get()
+      if first is None:
+        break
+      batch = [first]
+      deadline = time.time() + self.max_delay
+      while len(batch) < self.max_batch_size:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+          break
+        try:
+          request = self._requests.get(timeout=remaining)
+        except queue.Empty:
+          break
+        if request is None:
+          self._requests.put(None)
+          break
+        batch.append(request)
+
+      self.batch_sizes.append(len(batch))
+      try:
+        outputs = self.predict_fn(np.stack([image for image, _ in batch]))
+        for (_, future), output in zip(batch, outputs):
+          future.set_result(output)
+      except Exception as e:
+        for _, future in batch:
+          future.set_exception(e)
+
+  def close(self):
+    self._requests.put(None)
+    self._thread.join()
+
+def load_predict_fn(saved_model_path):
+  loaded = tf.keras.models.load_model(saved_model_path)
+  # fixed signature: one trace for every batch size
+  predict = tf.function(lambda x: loaded(x, training=False),
+                        input_signature=[tf.TensorSpec([None, 224, 224, 3], tf.float32)])
+  return lambda images: predict(images).numpy()
+
+def preprocess_image(data):
+  image = tf.io.decode_image(data, channels=3, expand_animations=False)
+  image = tf.image.resize(image, IMAGE_SHAPE) / 255.0
+  return image.numpy()
+
+def make_handler(batcher, class_names):
+  class PredictHandler(http.server.BaseHTTPRequestHandler):
+    def do_POST(self):
+      if self.path != '/predict':
+        self.send_error(404)
+        return
+      try:
+        data = self.rfile.read(int(self.headers['Content-Length']))
+        image = preprocess_image(data)
+      except Exception as e:
+        self.send_error(400, str(e))
+        return
+      try:
+        logits = batcher.submit(image).result()
+      except Exception as e:
+        # the request was fine, the model or the batcher failed
+        self.send_error(500, str(e))
+        return
+      body = json.dumps({'class': str(class_names[np.argmax(logits)]),
+                         'logits': logits.tolist()}).encode()
+      self.send_response(200)
+      self.send_header('Content-Type', 'application/json')
+      self.send_header('Content-Length', str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+
+    def log_message(self, format, *args):
+      pass
+  return PredictHandler
+
+def start_server(saved_model_path, class_names, port=0, **batcher_kwargs):
+  batcher = DynamicBatcher(load_predict_fn(saved_model_path), **batcher_kwargs)
+  server = http.server.ThreadingHTTPServer(('127.0.0.1', port),
+                                           make_handler(batcher, class_names))
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+  return server, batcher
+
+def run_load_test(url, images, concurrency=16, requests_per_client=50):
+  latencies = []
+
+  def client(client_id):
+    client_latencies = []
+    for i in range(requests_per_client):
+      data = images[(client_id + i) % len(images)]
+      request = urllib.request.Request(url, data=data, method='POST')
+      start = time.time()
+      with urllib.request.urlopen(request) as response:
+        response.read()
+      client_latencies.append(time.time() - start)
+    return client_latencies
+
+  start = time.time()
+  with concurrent.futures.ThreadPoolExecutor(concurrency) as pool:
+    for client_latencies in pool.map(client, range(concurrency)):
+      latencies.extend(client_latencies)
+  seconds = time.time() - start
+
+  p50, p99 = np.percentile(latencies, [50, 99]) * 1000
+  print("{:>3} clients: {:7.1f} images/sec, p50 {:6.1f}ms, p99 {:6.1f}ms".format(
+      concurrency, len(latencies) / seconds, p50, p99))
+  return latencies
+
+"""start the server on the exported model and send jpeg encoded images of the validation set:"""
+
+server, batcher = start_server(export_path, class_names,
+                               max_batch_size=32, max_delay=0.005)
+url = 'http://127.0.0.1:{}/predict'.format(server.server_address[1])
+
+test_images = [tf.io.encode_jpeg(tf.cast(image * 255, tf.uint8)).numpy()
+               for image in image_batch]
+
+for concurrency in [1, 8, 32]:
+  batcher.batch_sizes.clear()
+  run_load_test(url, test_images, concurrency=concurrency)
+  print("    mean batch size: {:.1f}".format(np.mean(batcher.batch_sizes)))
+
+server.shutdown()
+server.server_close()
+batcher.close()
+
+"""#Benchmark: MobileNetV2 vs. InceptionV3 feature extractor
+the choice between mobilenet_v2 and inception_v3 above is made without any cost data. benchmark_feature_extractors loads every candidate and measures on the CPU:
+*  model load time
+*  images/sec and mean latency per batch for batch sizes 1 to 256
+*  peak memory: the highest resident set size while loading and running the model, minus the resident set size before it. a background thread samples the RSS every few milliseconds, so every candidate gets its own peak independent of the order
+*  accuracy of a Dense head, trained for a few epochs on the features of a fixed training subset and evaluated on a fixed validation subset
+
+`load_layer` builds the hub layer from the handle, pass `hub_registry.keras_layer` to load the models from the offline registry.
+"""
+
+import resource
+
+try:
+  import psutil
+except ImportError:
+  psutil = None
+
+def memory_mb():
+  """current resident set size"""
+  if psutil is not None:
+    return psutil.Process().memory_info().rss / 2**20
+  with open('/proc/self/statm') as f:
+    resident_pages = int(f.read().split()[1])
+  return resident_pages * resource.getpagesize() / 2**20
+
+class PeakMemory(object):
+  """peak resident set size above the start value while the block runs"""
+  def __init__(self, interval=0.005):
+    self.interval = interval
+
+  def _sample(self):
+    while not self._stop.wait(self.interval):
+      self._peak = max(self._peak, memory_mb())
+
+  def __enter__(self):
+    self._start = self._peak = memory_mb()
+    self._stop = threading.Event()
+    self._thread = threading.Thread(target=self._sample, daemon=True)
+    self._thread.start()
+    return self
+
+  def __exit__(self, *exc_info):
+    self._stop.set()
+    self._thread.join()
+    self._peak = max(self._peak, memory_mb())
+    self.mb = self._peak - self._start
+
+FEATURE_EXTRACTORS = {
+    'mobilenet_v2': ("https://tfhub.dev/google/tf2-preview/mobilenet_v2/feature_vector/4", 224),
+    'inception_v3': ("https://tfhub.dev/google/tf2-preview/inception_v3/feature_vector/4", 299),
+}
+
+def benchmark_feature_extractors(extractors=FEATURE_EXTRACTORS,
+                                 batch_sizes=(1, 8, 32, 64, 128, 256),
+                                 num_train_batches=20, num_val_batches=10,
+                                 load_layer=hub.KerasLayer, steps=5):
+  # fixed subsets, the same images for every candidate
+  train_subset = list(train_ds.take(num_train_batches))
+  val_subset = list(val_ds.take(num_val_batches))
+  results = {}
+
+  for name, (handle, size) in extractors.items():
+    with tf.device('/CPU:0'), PeakMemory() as peak_memory:
+      start = time.time()
+      layer = load_layer(handle, trainable=False)
+      extract = tf.function(lambda x: layer(x),
+                            input_signature=[tf.TensorSpec([None, size, size, 3], tf.float32)])
+      extract(tf.zeros([1, size, size, 3]))
+      load_seconds = time.time() - start
+
+      timings = {}
+      for batch_size in batch_sizes:
+        images = tf.random.uniform([batch_size, size, size, 3])
+        extract(images)
+        start = time.time()
+        for _ in range(steps):
+          extract(images).numpy()
+        seconds = (time.time() - start) / steps
+        timings[batch_size] = (batch_size / seconds, 1000 * seconds)
+
+      def features(subset):
+        x = np.concatenate([extract(tf.image.resize(images, (size, size))).numpy()
+                            for images, _ in subset])
+        y = np.concatenate([labels.numpy() for _, labels in subset])
+        return x, y
+
+      train_features, train_labels = features(train_subset)
+      val_features, val_labels = features(val_subset)
+    memory = peak_memory.mb
+
+    head = tf.keras.Sequential([tf.keras.layers.Dense(num_classes)])
+    head.compile(optimizer=tf.keras.optimizers.Adam(),
+                 loss=tf.keras.losses.SparseCategoricalCrossentropy(from_logits=True),
+                 metrics=['acc'])
+    head.fit(train_features, train_labels, epochs=10, verbose=0)
+    _, accuracy = head.evaluate(val_features, val_labels, verbose=0)
+
+    results[name] = {'load_seconds': load_seconds, 'timings': timings,
+                     'peak_memory_mb': memory, 'accuracy': accuracy}
+
+  for name, result in results.items():
+    print("{}: load {:.1f}s, peak memory +{:.0f}MB, head accuracy {:.3f}".format(
+        name, result['load_seconds'], result['peak_memory_mb'], result['accuracy']))
+    for batch_size, (throughput, latency) in result['timings'].items():
+      print("  batch {:>3}: {:8.1f} images/sec, {:8.1f}ms per batch".format(
+          batch_size, throughput, latency))
+  return results
+
+extractor_results = benchmark_feature_extractors()
@@ -112,6 +112,13 @@ def custom_standardization(input_data):
   return tf.strings.regex_replace(stripped_html,
                                   '[%s]' % re.escape(string.punctuation), '')
 
+# One regex pass for html and punctuation with the same output: `<br />` is
+# replaced by its captured space, punctuation by the empty group.
+def fused_standardization(input_data):
+  return tf.strings.regex_replace(tf.strings.lower(input_data),
+                                  '<br( )/>|[%s]' % re.escape(string.punctuation),
+                                  r'\1')
+
 
 # Vocabulary size and number of words in a sequence.
 vocab_size = 10000
@@ -121,7 +128,7 @@ sequence_length = 100
 # integers. Note that the layer uses the custom standardization defined above.
 # Set maximum_sequence length as all samples are not of the same length.
 vectorize_layer = TextVectorization(
-    standardize=custom_standardization,
+    standardize=fused_standardization,
     max_tokens=vocab_size,
     output_mode='int',
     output_sequence_length=sequence_length)
@@ -196,4 +203,50 @@ try:
   files.download('vectors.tsv')
   files.download('metadata.tsv')
 except Exception:
-  pass
\ No newline at end of file
+  pass
+
+"""#Ragged model without a fixed sequence length
+output_sequence_length=100 cuts every longer review and pads every shorter one, the padding is embedded and averaged like real words.
+
+in ragged mode the TextVectorization layer emits a RaggedTensor with the real number of ids per review. Embedding looks up only these ids (the result is ragged again) and RaggedGlobalAveragePooling1D averages over the real tokens of each review. no review is truncated, and compute and memory scale with the number of tokens instead of batch_size * max length.
+"""
+
+class RaggedGlobalAveragePooling1D(tf.keras.layers.Layer):
+  def call(self, inputs):
+    if isinstance(inputs, tf.RaggedTensor):
+      # divide_no_nan: an empty review pools to zeros instead of nan
+      lengths = tf.cast(inputs.row_lengths(), inputs.dtype)[:, tf.newaxis]
+      return tf.math.divide_no_nan(tf.reduce_sum(inputs, axis=1), lengths)
+    return tf.reduce_mean(inputs, axis=1)
+
+ragged_vectorize_layer = TextVectorization(
+    standardize=fused_standardization,
+    max_tokens=vocab_size,
+    output_mode='int',
+    vocabulary=vectorize_layer.get_vocabulary(),
+    ragged=True)
+
+ragged_model = Sequential([
+  ragged_vectorize_layer,
+  Embedding(vocab_size, embedding_dim, name="embedding"),
+  RaggedGlobalAveragePooling1D(),
+  Dense(16, activation='relu'),
+  Dense(1)
+])
+
+ragged_model.compile(optimizer='adam',
+                     loss=tf.keras.losses.BinaryCrossentropy(from_logits=True),
+                     metrics=['accuracy'])
+
+"""tokens actually processed compared with the padded version:"""
+
+real_tokens = sum(int(ragged_vectorize_layer(text).flat_values.shape[0])
+                  for text, _ in train_ds)
+padded_tokens = sum(int(tf.size(vectorize_layer(text))) for text, _ in train_ds)
+print("ragged: {:,d} tokens, padded to {}: {:,d} tokens".format(
+    real_tokens, sequence_length, padded_tokens))
+
+ragged_model.fit(
+    train_ds,
+    validation_data=val_ds,
+    epochs=15)